@@ -0,0 +1,84 @@
+"""Per-answer CPU cost of rendering the admin copy and the respondent's navigation keyboard.
+
+    python benchmarks/bench_answer_render.py [--number 20000]
+
+"before" rebuilds the buttons and escapes the question text on every answer, as
+handle_message used to; "after" uses the survey compiled at startup and only escapes the
+user-supplied header and answer.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+from telegram.helpers import escape_markdown  # noqa: E402
+
+from smokebot2 import surveys  # noqa: E402
+
+HEADER = "Иван Иванов (@ivan_ivanov)"
+ANSWER = "Впервые попробовал в 14 лет, за гаражами с друзьями. Было неприятно, но хотелось казаться взрослым."
+
+
+def _escape_md(text: str) -> str:
+    return escape_markdown(text or "", version=2)
+
+
+def render_before(q_index: int):
+    question = questions[q_index]
+    message_md = (
+        f"*Ответ пользователя* {_escape_md(HEADER)}\n"
+        f"*Вопрос:* {_escape_md(question)}\n"
+        f"*Ответ:* {_escape_md(ANSWER)}"
+    )
+    buttons = []
+    if q_index > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data="back_question"))
+    if q_index + 1 < len(questions):
+        buttons.append(InlineKeyboardButton("➡️ Далее", callback_data="next_question"))
+    else:
+        buttons.append(InlineKeyboardButton("✅ Завершить", callback_data="finish_survey"))
+    return message_md, InlineKeyboardMarkup([buttons])
+
+
+SURVEY = surveys.get()
+questions = [q.text for q in SURVEY.questions]
+
+
+def render_after(q_index: int):
+    message_md = (
+        f"*Ответ пользователя* {_escape_md(HEADER)}\n"
+        f"*Вопрос:* {SURVEY.questions[q_index].text_md}\n"
+        f"*Ответ:* {_escape_md(ANSWER)}"
+    )
+    return message_md, SURVEY.nav_markup(q_index)
+
+
+def bench(fn, number: int) -> float:
+    """Best-of-5 microseconds per answer, cycling through every question."""
+    count = len(questions)
+
+    def run():
+        for i in range(number):
+            fn(i % count)
+
+    return min(timeit.repeat(run, number=1, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    assert all(render_before(i)[0] == render_after(i)[0] for i in range(len(questions)))
+    before = bench(render_before, args.number)
+    after = bench(render_after, args.number)
+    print(f"before: {before:.2f} µs/answer")
+    print(f"after:  {after:.2f} µs/answer")
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""Offline load test: smokebot2 against a local fake Bot API server.
+
+    python benchmarks/bench_load.py --users 500 --concurrency 200 [--baseline old.json]
+
+The bot runs in-process in polling mode with BOT_API_URL pointing at a tornado server that
+answers getUpdates/sendMessage/editMessageText/answerCallbackQuery/... like Telegram would.
+Every simulated user walks the whole survey (/start, start_survey, one answer plus
+next_question per question, finish_survey) and waits for the bot's reply before sending
+the next update. Latency is measured from the moment an update is handed to getUpdates
+until the bot's reply to that user reaches the server. The fake server shares the event
+loop with the bot, so compare results from the same machine rather than absolute numbers.
+
+Outbox rate limits are lifted unless --real-limits is given, so the numbers show what the
+bot itself can do. Results (latency percentiles overall and per step, updates/sec,
+outbound calls per survey by method, DB write rate) are written as JSON to --out.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tornado.httpserver import HTTPServer  # noqa: E402
+from tornado.web import Application, RequestHandler  # noqa: E402
+
+from loadgen import BASE_USER_ID, callback_update, message_update  # noqa: E402
+
+TOKEN = "123456:BENCHMARK"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "smokebot", "username": "smokebot_bench",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+# Calls the bot makes on its own rather than in response to an update.
+CONTROL_METHODS = {"getUpdates", "getMe", "deleteWebhook", "setWebhook", "getWebhookInfo", "close", "logOut"}
+REPLY_METHODS = {"sendMessage", "editMessageText"}
+
+
+def percentiles(values: list[float]) -> dict:
+    values = sorted(values)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(p * len(values)))] * 1000 if values else 0.0
+
+    return {"count": len(values), "p50_ms": pct(0.5), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+            "max_ms": values[-1] * 1000 if values else 0.0}
+
+
+class FakeBotAPI:
+    """Just enough of the Bot API for the survey flow; records every call it receives."""
+
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+        self.calls: Counter = Counter()
+        self._pending: list[dict] = []
+        self._has_updates = asyncio.Event()
+        self._inboxes: dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self._message_ids = 0
+        self._closed = False
+
+    def close(self):
+        """Releases a pending long poll so the server can stop cleanly."""
+        self._closed = True
+        self._has_updates.set()
+
+    def push(self, update: dict):
+        self._pending.append(update)
+        self._has_updates.set()
+
+    def inbox(self, user_id: int) -> asyncio.Queue:
+        return self._inboxes[user_id]
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        self._pending = [u for u in self._pending if u["update_id"] >= offset]
+        if not self._pending and not self._closed:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._pending[:limit]
+
+    def _message(self, chat_id: int, text: str) -> dict:
+        self._message_ids += 1
+        return {"message_id": self._message_ids, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        if method == "getMe":
+            return BOT_USER
+        if method in REPLY_METHODS:
+            chat_id = int(params["chat_id"])
+            if chat_id >= BASE_USER_ID:
+                self._inboxes[chat_id].put_nowait((method, time.perf_counter()))
+            return self._message(chat_id, params.get("text", ""))
+        return True
+
+
+class _MethodHandler(RequestHandler):
+    def initialize(self, api: FakeBotAPI):
+        self.api = api
+
+    async def post(self, token: str, method: str):
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")
+        else:
+            params = {k: self.get_body_argument(k) for k in self.request.body_arguments}
+        result = await self.api.call(method, params)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"ok": True, "result": result}))
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.api_latency / 1000)
+    server = HTTPServer(Application([(r"/bot([^/]+)/(\w+)", _MethodHandler, {"api": api})]))
+    server.listen(args.port, "127.0.0.1")
+    os.environ["BOT_API_URL"] = f"http://127.0.0.1:{args.port}"
+
+    import smokebot2  # reads its configuration from the environment prepared in main()
+
+    questions = args.questions or len(smokebot2.surveys.get())
+    app = smokebot2.build_app()
+    await app.initialize()
+    await app.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    await app.start()
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    timeouts = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def step(user_id: int, name: str, update: dict):
+        nonlocal timeouts
+        inbox = api.inbox(user_id)
+        sent = time.perf_counter()
+        api.push(update)
+        try:
+            _, received = await asyncio.wait_for(inbox.get(), args.timeout)
+        except asyncio.TimeoutError:
+            timeouts += 1
+            return
+        latencies[name].append(received - sent)
+        if args.think_time:
+            await asyncio.sleep(args.think_time / 1000)
+
+    async def simulate(user_id: int):
+        async with semaphore:
+            await step(user_id, "start", message_update(user_id, "/start"))
+            await step(user_id, "start_survey", callback_update(user_id, "start_survey"))
+            for q in range(questions):
+                await step(user_id, "answer", message_update(user_id, f"answer {q + 1} " + "x" * args.answer_size))
+                last = q + 1 == questions
+                await step(user_id, "finish_survey" if last else "next_question",
+                           callback_update(user_id, "finish_survey" if last else "next_question"))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate(BASE_USER_ID + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    outbox_stats = smokebot2.outbox.stats()
+
+    api.close()
+    await app.updater.stop()
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    server.stop()
+
+    conn = sqlite3.connect(smokebot2.DB_PATH)
+    try:
+        messages_written = conn.execute("SELECT count(*) FROM messages").fetchone()[0]
+    finally:
+        conn.close()
+
+    updates = sum(len(v) for v in latencies.values())
+    outbound = {m: n for m, n in sorted(api.calls.items()) if m not in CONTROL_METHODS}
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "questions": questions,
+        "elapsed_s": elapsed,
+        "updates": updates,
+        "timeouts": timeouts,
+        "updates_per_sec": updates / elapsed if elapsed else 0.0,
+        "latency": percentiles([x for v in latencies.values() for x in v]),
+        "latency_by_step": {name: percentiles(v) for name, v in sorted(latencies.items())},
+        "outbound_calls": outbound,
+        "outbound_calls_per_survey": sum(outbound.values()) / args.users if args.users else 0.0,
+        "db": {"messages_written": messages_written,
+               "writes_per_sec": messages_written / elapsed if elapsed else 0.0},
+        "outbox": outbox_stats,
+    }
+
+
+def compare(result: dict, baseline: dict):
+    rows = [("updates_per_sec", result["updates_per_sec"], baseline["updates_per_sec"])]
+    rows += [(f"latency {k}", result["latency"][k], baseline["latency"][k]) for k in ("p50_ms", "p95_ms", "p99_ms")]
+    rows.append(("outbound_calls_per_survey", result["outbound_calls_per_survey"],
+                 baseline["outbound_calls_per_survey"]))
+    print(f"{'':28}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, current, before in rows:
+        change = f"{(current / before - 1) * 100:+.1f}%" if before else "n/a"
+        print(f"{name:28}{before:12.2f}{current:12.2f}{change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100, help="users in flight at once")
+    parser.add_argument("--questions", type=int, help="questions to answer (default: the whole survey)")
+    parser.add_argument("--answer-size", type=int, default=200)
+    parser.add_argument("--think-time", type=float, default=0.0, help="ms a user waits between updates")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="ms the fake API takes per call")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for a reply")
+    parser.add_argument("--real-limits", action="store_true", help="keep the outbox's Telegram rate limits")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--out", help="result file (default: benchmarks/results/load-<revision>-<time>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_load-")
+    os.chdir(workdir)  # smokebot2 keeps its databases in the working directory
+    os.environ["BOT_TOKEN"] = TOKEN
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    os.environ.setdefault("SURVEY_RELOAD_INTERVAL", "3600")
+    if not args.real_limits:
+        os.environ["OUTBOX_GLOBAL_RATE"] = os.environ["OUTBOX_CHAT_RATE"] = "1000000"
+
+    result = asyncio.run(run(args))
+    out = args.out or os.path.join(ROOT, "benchmarks", "results",
+                                   f"load-{result['revision']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as fp:
+        json.dump(result, fp, indent=2)
+
+    latency = result["latency"]
+    print(f"{result['updates']} updates from {args.users} users in {result['elapsed_s']:.2f}s "
+          f"({result['updates_per_sec']:.0f} updates/s, {result['timeouts']} timeouts)")
+    print(f"latency p50 {latency['p50_ms']:.1f} ms, p95 {latency['p95_ms']:.1f} ms, p99 {latency['p99_ms']:.1f} ms")
+    print(f"{result['outbound_calls_per_survey']:.1f} outbound calls per survey, "
+          f"{result['db']['writes_per_sec']:.0f} DB writes/s")
+    print(f"results written to {out}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fp:
+            compare(result, json.load(fp))
+
+
+if __name__ == "__main__":
+    main()
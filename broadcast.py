@@ -0,0 +1,346 @@
+"""Admin broadcasts: recipients picked by a selector over the message store, delivered
+through the outbox at bulk priority, with progress checkpointed in SQLite.
+
+Selectors:
+
+    all                      everyone who ever wrote to the bot
+    abandoned[:<survey_id>]  started the survey, never finished, idle for a day
+    answered:<N>[:<words>][@<survey_id>]
+                             answered question N of the survey (with an answer containing
+                             the words; join several words with "+")
+
+Recipients are materialized when the broadcast is created. Delivery walks them in chunks
+and records each chunk's outcome before taking the next, so a restart resumes with the
+recipients still pending; at most the chunk in flight at a crash can be sent twice.
+Users who blocked the bot (403) are remembered in ``blocked_users`` and left out of
+later broadcasts until they write to the bot again.
+
+Processes sharing the database (webhook worker replicas) claim a running broadcast
+before delivering it: ``owner`` and ``lease_until`` are set with a conditional UPDATE,
+the lease is renewed at every checkpoint and released on shutdown, so each broadcast is
+delivered by one process at a time and taken over only once its lease has run out.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Optional
+
+from telegram.error import Forbidden
+
+from outbox import Outbox, PRIORITY_ADMIN, PRIORITY_BULK
+from storage import MessageStore, fts_query
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER NOT NULL,
+        selector TEXT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'draft',
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        started_at DATETIME,
+        finished_at DATETIME,
+        owner TEXT,
+        lease_until DATETIME
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS blocked_users (
+        user_id INTEGER PRIMARY KEY,
+        blocked_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+# Columns added after the first release of the table.
+ADDED_COLUMNS = [("owner", "TEXT"), ("lease_until", "DATETIME")]
+
+_CLAIM = """
+    UPDATE broadcasts SET owner = :owner, lease_until = datetime('now', :lease)
+    WHERE id = :id AND status = 'running'
+      AND (owner IS NULL OR owner = :owner OR lease_until < datetime('now'))
+"""
+
+_ABANDONED_SQL = """
+    SELECT user_id FROM survey_events WHERE survey_id = ?
+    GROUP BY user_id
+    HAVING sum(event = 'finish') = 0 AND max(timestamp) < datetime('now', '-1 day')
+"""
+# Messages saved before survey_id was recorded belong to the default survey.
+_ANSWERED_SQL = """
+    SELECT user_id FROM messages
+    WHERE from_admin = 0 AND q_index = ? AND coalesce(survey_id, ?) = ?
+"""
+_ANSWERED_MATCH_SQL = """
+    SELECT m.user_id FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+    WHERE messages_fts MATCH ? AND m.q_index = ? AND coalesce(m.survey_id, ?) = ?
+"""
+
+
+def selector_sql(selector: str, default_survey: Optional[str] = None, fts: bool = True) -> tuple[str, tuple]:
+    """SQL returning the user ids a selector stands for; ``ValueError`` if it is malformed."""
+    kind, _, rest = selector.partition(":")
+    if kind == "all" and not rest:
+        return "SELECT user_id FROM users", ()
+    if kind == "abandoned":
+        survey_id = rest or default_survey
+        if not survey_id:
+            raise ValueError("abandoned needs a survey id")
+        return _ABANDONED_SQL, (survey_id,)
+    if kind == "answered":
+        rest, _, survey_id = rest.partition("@")
+        survey_id = survey_id or default_survey
+        number, _, words = rest.partition(":")
+        if not number.isdigit() or int(number) < 1:
+            raise ValueError("answered needs a question number")
+        if not survey_id:
+            raise ValueError("answered needs a survey id")
+        scope = (int(number) - 1, default_survey, survey_id)
+        match = fts_query(words.replace("+", " "))
+        if match:
+            if not fts:
+                raise ValueError("matching answer text needs FTS5")
+            return _ANSWERED_MATCH_SQL, (match, *scope)
+        return _ANSWERED_SQL, scope
+    raise ValueError(f"Unknown selector: {selector}")
+
+
+class Broadcasts:
+    def __init__(self, store: MessageStore, outbox: Outbox, default_survey: Optional[str] = None,
+                 exclude: tuple = (), chunk_size: int = 100, report_interval: float = 60.0,
+                 lease: float = 300.0):
+        self.store = store
+        self.outbox = outbox
+        self.default_survey = default_survey
+        self.exclude = tuple(exclude)
+        self.chunk_size = chunk_size
+        self.report_interval = report_interval
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._progress: dict[int, dict] = {}
+        self._stopping = False
+
+    @property
+    def _lease_modifier(self) -> str:
+        return f"+{self.lease:.0f} seconds"
+
+    async def start(self):
+        """Creates the tables and resumes broadcasts that were running at shutdown."""
+        def create(conn):
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(broadcasts)")}
+            for column, declaration in ADDED_COLUMNS:
+                if existing and column not in existing:
+                    conn.execute(f"ALTER TABLE broadcasts ADD COLUMN {column} {declaration}")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+
+        await self.store.run(create)
+        await self.resume()
+
+    async def resume(self) -> int:
+        """Claims running broadcasts nobody holds a live lease on; returns how many."""
+        def claim(conn, broadcast_ids):
+            claimed = []
+            for broadcast_id in broadcast_ids:
+                cursor = conn.execute(_CLAIM, {"owner": self.owner, "lease": self._lease_modifier, "id": broadcast_id})
+                if cursor.rowcount:
+                    claimed.append(broadcast_id)
+            conn.commit()
+            return claimed
+
+        rows = await self.store.fetchall(
+            "SELECT id FROM broadcasts WHERE status = 'running' "
+            "AND (owner IS NULL OR owner = ? OR lease_until < datetime('now'))", (self.owner,))
+        candidates = [broadcast_id for broadcast_id, in rows if broadcast_id not in self._tasks]
+        if self._stopping or not candidates:
+            return 0
+        await self.store.flush()
+        claimed = await self.store.run(claim, candidates)
+        for broadcast_id in claimed:
+            logger.info("Resuming broadcast %d", broadcast_id)
+            self._spawn(broadcast_id)
+        return len(claimed)
+
+    async def create(self, admin_id: int, selector: str, text: str) -> tuple[int, int]:
+        """Stores a draft and its recipients; returns (broadcast id, number of recipients)."""
+        sql, params = selector_sql(selector, self.default_survey, self.store.fts)
+        where = "user_id NOT IN (SELECT user_id FROM blocked_users)"
+        if self.exclude:
+            where += f" AND user_id NOT IN ({','.join('?' * len(self.exclude))})"
+
+        def create(conn):
+            cursor = conn.execute("INSERT INTO broadcasts (admin_id, selector, text) VALUES (?, ?, ?)",
+                                  (admin_id, selector, text))
+            broadcast_id = cursor.lastrowid
+            total = conn.execute(
+                f"INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) "
+                f"SELECT ?, user_id FROM ({sql}) WHERE {where}",
+                (broadcast_id, *params, *self.exclude)).rowcount
+            conn.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (total, broadcast_id))
+            conn.commit()
+            return broadcast_id, total
+
+        await self.store.flush()
+        return await self.store.run(create)
+
+    async def get(self, broadcast_id: int) -> Optional[dict]:
+        rows = await self.store.fetchall(
+            "SELECT id, admin_id, selector, text, status, total, sent, failed, blocked, "
+            "(julianday(coalesce(finished_at, CURRENT_TIMESTAMP)) - julianday(started_at)) * 86400 "
+            "FROM broadcasts WHERE id = ?", (broadcast_id,))
+        if not rows:
+            return None
+        keys = ("id", "admin_id", "selector", "text", "status", "total", "sent", "failed", "blocked", "elapsed")
+        return dict(zip(keys, rows[0]))
+
+    async def recent(self, limit: int = 5) -> list[dict]:
+        rows = await self.store.fetchall("SELECT id FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+        return [await self.get(broadcast_id) for broadcast_id, in rows]
+
+    async def launch(self, broadcast_id: int) -> bool:
+        def start(conn):
+            cursor = conn.execute(
+                "UPDATE broadcasts SET status = 'running', started_at = CURRENT_TIMESTAMP, "
+                "owner = ?, lease_until = datetime('now', ?) WHERE id = ? AND status = 'draft'",
+                (self.owner, self._lease_modifier, broadcast_id))
+            conn.commit()
+            return cursor.rowcount == 1
+
+        if not await self.store.run(start):
+            return False
+        self._spawn(broadcast_id)
+        return True
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        broadcast = await self.get(broadcast_id)
+        if broadcast is None or broadcast["status"] not in ("draft", "running"):
+            return False
+        task = self._tasks.pop(broadcast_id, None)
+        if task:
+            task.cancel()
+        self.store.enqueue("UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP "
+                           "WHERE id = ?", (broadcast_id,))
+        await self.store.flush()
+        return True
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def unblock(self, user_id: int):
+        """The user wrote to the bot, so they can be reached again."""
+        self.store.enqueue("DELETE FROM blocked_users WHERE user_id = ?", (user_id,))
+
+    def progress(self, broadcast_id: int) -> Optional[dict]:
+        """Live counters of a broadcast running in this process."""
+        return self._progress.get(broadcast_id)
+
+    def _spawn(self, broadcast_id: int):
+        task = asyncio.create_task(self._run(broadcast_id), name=f"broadcast-{broadcast_id}")
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id: int):
+        broadcast = await self.get(broadcast_id)
+        progress = self._progress[broadcast_id] = {"sent": 0, "failed": 0, "blocked": 0, "started": time.monotonic()}
+        last_report = time.monotonic()
+        cursor = 0
+        try:
+            while True:
+                if self._stopping:
+                    # Stays 'running'; released so the next process to start picks it up.
+                    self.store.enqueue("UPDATE broadcasts SET owner = NULL, lease_until = NULL "
+                                       "WHERE id = ? AND owner = ?", (broadcast_id, self.owner))
+                    return
+                held = await self.store.fetchall(
+                    "SELECT 1 FROM broadcasts WHERE id = ? AND status = 'running' AND owner = ?",
+                    (broadcast_id, self.owner))
+                if not held:
+                    logger.info("Broadcast %d was cancelled or taken over, stopping", broadcast_id)
+                    return
+                rows = await self.store.fetchall(
+                    "SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending' "
+                    "AND user_id > ? ORDER BY user_id LIMIT ?", (broadcast_id, cursor, self.chunk_size))
+                if not rows:
+                    break
+                user_ids = [row[0] for row in rows]
+                cursor = user_ids[-1]
+                futures = [self.outbox.send_message(uid, broadcast["text"], priority=PRIORITY_BULK)
+                           for uid in user_ids]
+                results = await asyncio.gather(*futures, return_exceptions=True)
+                self._checkpoint(broadcast_id, user_ids, results, progress)
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    logger.info("Broadcast %d: %s", broadcast_id, self._describe(progress))
+        except Exception:
+            logger.exception("Broadcast %d failed", broadcast_id)
+            return
+        finally:
+            self._progress.pop(broadcast_id, None)
+
+        self.store.enqueue("UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP "
+                           "WHERE id = ? AND status = 'running'", (broadcast_id,))
+        report = f"📣 Рассылка #{broadcast_id} завершена: {self._describe(progress)}"
+        logger.info(report)
+        self.outbox.send_message(broadcast["admin_id"], report, priority=PRIORITY_ADMIN)
+
+    def _checkpoint(self, broadcast_id: int, user_ids: list, results: list, progress: dict):
+        outcome: dict[str, list] = {"sent": [], "failed": [], "blocked": []}
+        for uid, result in zip(user_ids, results):
+            if isinstance(result, Forbidden):
+                outcome["blocked"].append(uid)
+            elif isinstance(result, BaseException):
+                outcome["failed"].append(uid)
+            else:
+                outcome["sent"].append(uid)
+        for status, uids in outcome.items():
+            if not uids:
+                continue
+            progress[status] += len(uids)
+            self.store.enqueue(
+                f"UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? "
+                f"AND user_id IN ({','.join('?' * len(uids))})", (status, broadcast_id, *uids))
+        for uid in outcome["blocked"]:
+            self.store.enqueue("INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)", (uid,))
+        self.store.enqueue("UPDATE broadcasts SET sent = sent + ?, failed = failed + ?, blocked = blocked + ?, "
+                           "lease_until = datetime('now', ?) WHERE id = ?",
+                           (len(outcome["sent"]), len(outcome["failed"]), len(outcome["blocked"]),
+                            self._lease_modifier, broadcast_id))
+
+    @staticmethod
+    def _describe(progress: dict) -> str:
+        elapsed = time.monotonic() - progress["started"]
+        done = progress["sent"] + progress["failed"] + progress["blocked"]
+        return (f"отправлено {progress['sent']}, ошибок {progress['failed']}, "
+                f"заблокировали бота {progress['blocked']}, {done / elapsed if elapsed else 0:.1f} сообщ./с")
+
+    async def close(self, timeout: float = 30.0):
+        """Lets running broadcasts finish their current chunk, so its outcome is recorded."""
+        self._stopping = True
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import Optional
+
+from telegram.constants import MessageLimit, ParseMode
+from telegram.helpers import escape_markdown
+
+from outbox import Outbox, PRIORITY_ADMIN
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = MessageLimit.MAX_TEXT_LENGTH
+
+
+def _escape_md(text: str) -> str:
+    return escape_markdown(text or "", version=2)
+
+
+def _safe_cut(text: str, limit: int) -> int:
+    """Largest cut position <= limit that does not separate a MarkdownV2 escape from its char."""
+    cut = limit
+    backslashes = 0
+    while cut - backslashes - 1 >= 0 and text[cut - backslashes - 1] == "\\":
+        backslashes += 1
+    return cut - 1 if backslashes % 2 else cut
+
+
+def split_markdown(header: str, blocks: list[str], limit: int = MESSAGE_LIMIT) -> list[str]:
+    """Packs MarkdownV2 blocks into messages of at most ``limit`` characters.
+
+    Blocks are kept whole where possible; a block that alone exceeds the limit is cut at
+    escape-safe positions. Continuation messages repeat the header.
+    """
+    messages = []
+    current = header
+    for block in blocks:
+        separator = "\n\n" if current != header else ""
+        if len(current) + len(separator) + len(block) <= limit:
+            current += separator + block
+            continue
+        if current != header:
+            messages.append(current)
+            current = header
+        while len(header) + len(block) > limit:
+            cut = _safe_cut(block, limit - len(header))
+            messages.append(header + block[:cut])
+            block = block[cut:]
+        current = header + block
+    if current != header or not messages:
+        messages.append(current)
+    return messages
+
+
+class DigestBuffer:
+    """Buffers respondents' answers and sends admins one consolidated message per respondent.
+
+    A respondent's digest goes out on ``flush`` (the survey is finished), after
+    ``idle_window`` seconds without a new answer, or once ``max_answers`` answers are buffered.
+    """
+
+    def __init__(self, outbox: Outbox, admin_ids: list[int], idle_window: float = 600.0,
+                 max_answers: int = 7):
+        self.outbox = outbox
+        self.admin_ids = admin_ids
+        self.idle_window = idle_window
+        self.max_answers = max_answers
+        self._headers: dict[int, str] = {}
+        self._blocks: dict[int, list[str]] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+
+    def add(self, user_id: int, header: str, question_md: str, answer: str):
+        """Buffers one answer; ``header`` is raw text, ``question_md`` is already escaped."""
+        self._headers[user_id] = header
+        blocks = self._blocks.setdefault(user_id, [])
+        blocks.append(f"*Вопрос:* {question_md}\n*Ответ:* {_escape_md(answer)}")
+        timer = self._timers.pop(user_id, None)
+        if timer:
+            timer.cancel()
+        if len(blocks) >= self.max_answers:
+            self.flush(user_id)
+        else:
+            loop = asyncio.get_running_loop()
+            self._timers[user_id] = loop.call_later(self.idle_window, self.flush, user_id)
+
+    def flush(self, user_id: int):
+        timer = self._timers.pop(user_id, None)
+        if timer:
+            timer.cancel()
+        blocks = self._blocks.pop(user_id, None)
+        header = self._headers.pop(user_id, "")
+        if not blocks:
+            return
+        title = f"*Ответы пользователя* {_escape_md(header)}\n\n"
+        for text in split_markdown(title, blocks):
+            for admin_id in self.admin_ids:
+                self.outbox.send_message(admin_id, text, priority=PRIORITY_ADMIN, parse_mode=ParseMode.MARKDOWN_V2)
+
+    def flush_all(self):
+        for user_id in list(self._blocks):
+            self.flush(user_id)
+
+    def pending(self, user_id: Optional[int] = None) -> int:
+        if user_id is not None:
+            return len(self._blocks.get(user_id, ()))
+        return sum(len(b) for b in self._blocks.values())
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def _update_key(update: object) -> Optional[int]:
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently across users but strictly in order within a user.
+
+    At most ``max_concurrent_updates`` handlers run at once. Updates of a user that already
+    has ``max_user_backlog`` updates pending are dropped. Updates without a user are not
+    serialized.
+    """
+
+    __slots__ = ("limit", "_slots", "_running", "_users", "max_user_backlog", "dropped")
+
+    # The base class takes its semaphore (sized by ``max_concurrent_updates``) before
+    # do_process_update, i.e. before the per-user lock, so one user's backlog could hold
+    # every slot. It gets this many slots instead, and the real cap is applied with our own
+    # semaphore once the user's turn has come; ``max_concurrent_updates`` therefore reports
+    # this value, ``limit`` the cap.
+    _BASE_SLOTS = 2 ** 16
+
+    def __init__(self, max_concurrent_updates: int = 64, max_user_backlog: int = 20):
+        super().__init__(max_concurrent_updates=self._BASE_SLOTS)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._running = 0
+        self._users: dict[int, list] = {}  # user_id -> [lock, updates holding or waiting]
+        self.max_user_backlog = max_user_backlog
+        self.dropped = 0
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._running
+
+    async def _run(self, coroutine: Awaitable[Any]):
+        async with self._slots:
+            self._running += 1
+            try:
+                await coroutine
+            finally:
+                self._running -= 1
+
+    def backlog(self, user_id: int) -> int:
+        entry = self._users.get(user_id)
+        return entry[1] if entry else 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = _update_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        if entry[1] >= self.max_user_backlog:
+            self.dropped += 1
+            logger.warning("Dropping update from %s: %d updates already pending", key, entry[1])
+            coroutine.close()
+            return
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,136 @@
+"""Exports survey answers as one row per respondent and one column per question.
+
+    python export.py --db support_bot.db --format csv --out answers.csv
+
+Rows are streamed from SQLite in fixed-size chunks and written as they are produced, so
+memory use does not depend on the size of the database. ``parquet`` needs pyarrow.
+"""
+import argparse
+import csv
+import json
+import sqlite3
+from typing import Iterator, Optional
+
+FORMATS = ("csv", "jsonl", "parquet")
+
+_ANSWERS_SQL = """
+    SELECT user_id, q_index, text, timestamp FROM messages
+    WHERE from_admin = 0 AND q_index IS NOT NULL AND NOT superseded AND (:survey IS NULL OR coalesce(survey_id, :untagged) = :survey)
+    ORDER BY user_id, id
+"""
+
+
+def connect_readonly(db_path: str) -> sqlite3.Connection:
+    # A separate read-only connection sees a consistent WAL snapshot and never blocks the writer.
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+
+def columns(questions: int) -> list[str]:
+    return ["user_id", "first_answer_at", "last_answer_at"] + [f"q{i + 1}" for i in range(questions)]
+
+
+def iter_respondents(conn: sqlite3.Connection, questions: int, chunk_size: int = 1000,
+                     survey_id: Optional[str] = None, untagged_survey: Optional[str] = None) -> Iterator[dict]:
+    """Yields one dict per respondent; a re-answered question keeps its latest answer and
+    answers superseded by a different branch or a retake are left out.
+
+    ``survey_id`` limits the export to one survey; answers stored before surveys were tagged
+    count as ``untagged_survey``.
+    """
+    cursor = conn.execute(_ANSWERS_SQL, {"survey": survey_id, "untagged": untagged_survey})
+    current: Optional[dict] = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for user_id, q_index, text, timestamp in rows:
+            if current is None or current["user_id"] != user_id:
+                if current is not None:
+                    yield current
+                current = {"user_id": user_id, "first_answer_at": timestamp, "last_answer_at": timestamp}
+                current.update((f"q{i + 1}", None) for i in range(questions))
+            if 0 <= q_index < questions:
+                current[f"q{q_index + 1}"] = text
+            current["last_answer_at"] = timestamp
+    if current is not None:
+        yield current
+
+
+def write_csv(rows: Iterator[dict], out_path: str, questions: int) -> int:
+    count = 0
+    with open(out_path, "w", newline="", encoding="utf-8-sig") as fp:
+        writer = csv.DictWriter(fp, fieldnames=columns(questions))
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_jsonl(rows: Iterator[dict], out_path: str, questions: int) -> int:
+    count = 0
+    with open(out_path, "w", encoding="utf-8") as fp:
+        for row in rows:
+            fp.write(json.dumps(row, ensure_ascii=False))
+            fp.write("\n")
+            count += 1
+    return count
+
+
+def write_parquet(rows: Iterator[dict], out_path: str, questions: int, row_group_size: int = 1000) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow: pip install pyarrow") from None
+
+    names = columns(questions)
+    schema = pa.schema([("user_id", pa.int64())] + [(name, pa.string()) for name in names[1:]])
+    count = 0
+    with pq.ParquetWriter(out_path, schema) as writer:
+        batch: dict[str, list] = {name: [] for name in names}
+        for row in rows:
+            for name in names:
+                batch[name].append(row[name])
+            count += 1
+            if len(batch["user_id"]) >= row_group_size:
+                writer.write_table(pa.table(batch, schema=schema))
+                batch = {name: [] for name in names}
+        if batch["user_id"] or not count:
+            writer.write_table(pa.table(batch, schema=schema))
+    return count
+
+
+_WRITERS = {"csv": write_csv, "jsonl": write_jsonl, "parquet": write_parquet}
+
+
+def export(db_path: str, out_path: str, fmt: str, questions: int, chunk_size: int = 1000,
+           survey_id: Optional[str] = None, untagged_survey: Optional[str] = None) -> int:
+    """Writes the export to ``out_path`` and returns the number of respondents."""
+    if fmt not in _WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    conn = connect_readonly(db_path)
+    try:
+        rows = iter_respondents(conn, questions, chunk_size, survey_id, untagged_survey)
+        return _WRITERS[fmt](rows, out_path, questions)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="support_bot.db")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--questions", type=int, default=7)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--survey", help="only this survey id")
+    parser.add_argument("--untagged-survey", help="survey id to assume for answers stored without one")
+    args = parser.parse_args()
+    count = export(args.db, args.out, args.format, args.questions, args.chunk_size,
+                   args.survey, args.untagged_survey)
+    print(f"Exported {count} respondents to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Replays synthetic Telegram updates into a webhook endpoint and reports throughput.
+
+    python loadgen.py --url http://localhost:8080/webhook --users 500 --concurrency 100 \\
+        --stats http://localhost:8081/stats --stats http://localhost:8082/stats
+
+Every simulated user walks the whole survey (/start, start_survey, one answer plus
+next_question per question, finish_survey); a user's updates are posted one after another,
+users run concurrently.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+from webhook import SECRET_HEADER, shard_for
+
+BASE_USER_ID = 10_000_000
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load{user_id}"}
+
+
+def message_update(user_id: int, text: str) -> dict:
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "smokebot"},
+                "text": "…",
+            },
+        },
+    }
+
+
+def survey_updates(user_id: int, questions: int, answer_size: int) -> list[dict]:
+    updates = [message_update(user_id, "/start"), callback_update(user_id, "start_survey")]
+    for q in range(questions):
+        updates.append(message_update(user_id, f"answer {q + 1} " + "x" * answer_size))
+        updates.append(callback_update(user_id, "next_question" if q + 1 < questions else "finish_survey"))
+    return updates
+
+
+async def run(args) -> dict:
+    client = AsyncHTTPClient(max_clients=args.concurrency)
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers[SECRET_HEADER] = args.secret
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    per_shard = [0] * args.workers
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(update: dict):
+        request = HTTPRequest(args.url, method="POST", body=json.dumps(update), headers=headers,
+                              request_timeout=30)
+        started = time.perf_counter()
+        try:
+            response = await client.fetch(request)
+            code = response.code
+        except HTTPClientError as e:
+            code = e.code
+        except OSError:
+            code = 0
+        latencies.append(time.perf_counter() - started)
+        statuses[code] = statuses.get(code, 0) + 1
+
+    async def simulate(user_id: int):
+        async with semaphore:
+            for update in survey_updates(user_id, args.questions, args.answer_size):
+                per_shard[shard_for(user_id, args.workers)] += 1
+                await post(update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate(BASE_USER_ID + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+    worker_stats = []
+    for url in args.stats:
+        try:
+            response = await client.fetch(url)
+            worker_stats.append({"url": url, **json.loads(response.body)})
+        except (HTTPClientError, OSError) as e:
+            worker_stats.append({"url": url, "error": str(e)})
+
+    return {
+        "users": args.users,
+        "updates": len(latencies),
+        "elapsed": elapsed,
+        "updates_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "updates_per_sec_per_worker": len(latencies) / elapsed / args.workers if elapsed else 0.0,
+        "post_latency": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99)},
+        "statuses": statuses,
+        "updates_per_shard": per_shard,
+        "worker_stats": worker_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080/webhook")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--questions", type=int, default=7)
+    parser.add_argument("--answer-size", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1, help="number of shards behind the router")
+    parser.add_argument("--secret", help="X-Telegram-Bot-Api-Secret-Token to send")
+    parser.add_argument("--stats", action="append", default=[], help="worker/router /stats URL to collect")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""In-process metrics in the Prometheus text format, without the client library.
+
+Counters, gauges and histograms live in a ``Registry`` (``REGISTRY`` by default). Values
+are updated from the event loop only, so no locking is needed. Gauges and counters may
+instead be given ``fn``, called (and awaited if it returns a coroutine) on every scrape.
+
+``routes()`` returns tornado routes for ``/metrics`` (and ``/debug/profile`` when a
+``SamplingProfiler`` is given) to mount on the webhook server; ``serve()`` runs them on a
+standalone port for polling mode.
+"""
+import functools
+import inspect
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional, Union
+
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Number = Union[int, float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: Number) -> str:
+    return "+Inf" if value == float("inf") else repr(value)
+
+
+def _format(name: str, labels: dict, value: Number) -> str:
+    if labels:
+        pairs = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+        name = f"{name}{{{pairs}}}"
+    return f"{name} {_number(value)}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = (),
+                 fn: Optional[Callable[[], Union[Number, Awaitable[Number]]]] = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.fn = fn
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    async def _collect(self) -> list[str]:
+        if self.fn is not None:
+            value = self.fn()
+            if inspect.isawaitable(value):
+                value = await value
+            return [_format(self.name, {}, value)]
+        return [_format(self.name, dict(zip(self.labelnames, key)), value)
+                for key, value in sorted(self._values.items())]
+
+    async def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + await self._collect()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: Number = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: Number, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: Number = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: Number = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket (not cumulative) counts, then sum and count.
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    async def _collect(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(_format(f"{self.name}_bucket", {**labels, "le": _number(bound)}, cumulative))
+            lines.append(_format(f"{self.name}_sum", labels, total))
+            lines.append(_format(f"{self.name}_count", labels, count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"Metric {metric.name} is already registered as a {existing.kind}")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = (), fn=None) -> Counter:
+        return self._register(Counter(name, help, labels, fn))
+
+    def gauge(self, name: str, help: str, labels: tuple = (), fn=None) -> Gauge:
+        return self._register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(await metric.render())
+            except Exception:
+                # One broken callback must not take the whole scrape down.
+                logger.exception("Failed to collect metric %s", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+_STARTED = time.time()
+gauge("process_start_time_seconds", "Start time of the process since the epoch.", fn=lambda: _STARTED)
+counter("process_cpu_seconds_total", "User and system CPU time spent.", fn=time.process_time)
+
+HANDLER_SECONDS = histogram("bot_handler_duration_seconds", "Time spent in an update handler.", ("handler",))
+HANDLER_ERRORS = counter("bot_handler_errors_total", "Update handlers that raised.", ("handler",))
+API_SECONDS = histogram("bot_api_request_duration_seconds", "Bot API round-trip time.", ("method",))
+API_RESPONSES = counter("bot_api_responses_total", "Bot API responses by HTTP status.", ("method", "status"))
+API_ERRORS = counter("bot_api_errors_total", "Bot API requests that failed without a response.", ("method",))
+
+
+def _timed(callback: Callable, name: str) -> Callable:
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    wrapper.__wrapped_for_metrics__ = True
+    return wrapper
+
+
+def instrument_handlers(app: Application):
+    """Times every handler registered on ``app`` so far, labelled with its callback name."""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+            if not getattr(callback, "__wrapped_for_metrics__", False):
+                handler.callback = _timed(callback, getattr(callback, "__name__", type(handler).__name__))
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """``HTTPXRequest`` that records the duration and status of every Bot API call."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(method=api_method)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, method=api_method)
+        API_RESPONSES.inc(method=api_method, status=code)
+        return code, payload
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread (the event loop's by default) ``hz`` times a second
+    from a daemon thread. ``folded()`` returns collapsed stacks ("a;b;c count" per line)
+    for flamegraph.pl or speedscope."""
+
+    def __init__(self, hz: float = 100, max_depth: int = 64):
+        self.interval = 1 / hz
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks: _Tally = _Tally()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, thread_id: Optional[int] = None):
+        target = thread_id or threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(target,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, thread_id: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def folded(self, reset: bool = False) -> str:
+        stacks = self._stacks
+        if reset:
+            self._stacks, self.samples = _Tally(), 0
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class _MetricsHandler(RequestHandler):
+    def initialize(self, registry: Registry):
+        self.registry = registry
+
+    async def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(await self.registry.render())
+
+
+class _ProfileHandler(RequestHandler):
+    def initialize(self, profiler: SamplingProfiler):
+        self.profiler = profiler
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.write(self.profiler.folded(reset=self.get_argument("reset", "0") == "1"))
+
+
+def routes(registry: Registry = REGISTRY, profiler: Optional[SamplingProfiler] = None) -> list:
+    result = [("/metrics", _MetricsHandler, {"registry": registry})]
+    if profiler is not None:
+        result.append(("/debug/profile", _ProfileHandler, {"profiler": profiler}))
+    return result
+
+
+def serve(port: int, listen: str = "127.0.0.1", registry: Registry = REGISTRY,
+          profiler: Optional[SamplingProfiler] = None) -> HTTPServer:
+    """Starts a standalone metrics server on the running event loop."""
+    server = HTTPServer(WebApplication(routes(registry, profiler)))
+    server.listen(port, listen)
+    return server
@@ -0,0 +1,263 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Lower value goes first.
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 10
+PRIORITY_BULK = 20
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available."""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        """Takes a token, going into debt if needed, and returns how long to wait for it."""
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class _Job:
+    priority: int
+    seq: int
+    chat_id: int
+    call: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    enqueued_at: float
+
+
+def _retrieve(future: asyncio.Future):
+    # Failures are logged by the outbox; callers that do not await the future should not
+    # trigger "exception was never retrieved" warnings.
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    """Outbound delivery queue with global and per-chat token buckets.
+
+    Each chat has its own FIFO; a chat becomes eligible once its bucket has a token, and
+    eligible chats are served by the priority of their oldest job (``PRIORITY_USER`` before
+    ``PRIORITY_ADMIN`` before ``PRIORITY_BULK``), so a throttled chat never ties up a worker.
+    ``RetryAfter`` pauses every worker for the requested time; timeouts and other transport
+    errors are retried with exponential backoff, requests Telegram rejects are not.
+    """
+
+    def __init__(self, workers: int = 8, global_rate: float = 30.0, chat_rate: float = 1.0,
+                 chat_burst: float = 3.0, max_attempts: int = 5, backoff: float = 0.5,
+                 report_interval: float = 60.0):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.report_interval = report_interval
+        self.bot: Optional[Bot] = None
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._chats: dict[int, deque] = {}  # chat_id -> queued jobs, only while non-empty or in flight
+        self._busy: set[int] = set()
+        self._ready: list = []  # heap of (priority, seq, chat_id)
+        self._delayed: list = []  # heap of (ready_at, priority, seq, chat_id)
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._seq = itertools.count()
+        self._tasks: list[asyncio.Task] = []
+        self._resume_at = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.flood_waits = 0
+        self._latencies: deque = deque(maxlen=1000)
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker(), name=f"outbox-{i}") for i in range(self.workers)]
+        if self.report_interval:
+            self._tasks.append(asyncio.create_task(self._report_loop(), name="outbox-report"))
+
+    def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]], priority: int = PRIORITY_USER) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_retrieve)
+        job = _Job(priority, next(self._seq), chat_id, call, future, time.monotonic())
+        jobs = self._chats.get(chat_id)
+        if jobs is None:
+            jobs = self._chats[chat_id] = deque()
+        jobs.append(job)
+        self.queued += 1
+        self._idle.clear()
+        if len(jobs) == 1 and chat_id not in self._busy:
+            self._schedule(chat_id)
+        return future
+
+    def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_USER, **kwargs) -> asyncio.Future:
+        return self.submit(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs), priority)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id: int):
+        head = self._chats[chat_id][0]
+        delay = self._chat_bucket(chat_id).delay()
+        if delay:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    async def _next_chat(self) -> int:
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+            if self._ready:
+                return heapq.heappop(self._ready)[2]
+            self._wakeup.clear()
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._next_chat()
+            jobs = self._chats[chat_id]
+            job = jobs.popleft()
+            self._busy.add(chat_id)
+            self.queued -= 1
+            self.in_flight += 1
+            try:
+                self._chat_bucket(chat_id).reserve()
+                await self._deliver(job)
+            except Exception:
+                logger.exception("Outbox worker failed on chat %s", chat_id)
+            finally:
+                self.in_flight -= 1
+                self._busy.discard(chat_id)
+                if jobs:
+                    self._schedule(chat_id)
+                else:
+                    del self._chats[chat_id]
+                if not self.queued and not self.in_flight:
+                    self._idle.set()
+
+    async def _deliver(self, job: _Job):
+        attempt = 0
+        while not job.future.done():
+            pause = self._resume_at - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await asyncio.sleep(self._global.reserve())
+            try:
+                result = await job.call()
+            except RetryAfter as e:
+                self.flood_waits += 1
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                logger.warning("Flood control on chat %s, pausing %.1fs", job.chat_id, delay)
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                continue
+            except (BadRequest, Forbidden) as e:
+                # BadRequest subclasses NetworkError, but a rejected request fails the same way again.
+                self._fail(job, e)
+                return
+            except NetworkError as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    self._fail(job, e)
+                    return
+                self.retries += 1
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * (1 + random.random()))
+                continue
+            except Exception as e:
+                self._fail(job, e)
+                return
+            self.sent += 1
+            self._latencies.append(time.monotonic() - job.enqueued_at)
+            job.future.set_result(result)
+
+    def _fail(self, job: _Job, error: Exception):
+        self.failed += 1
+        logger.warning("Dropping message to chat %s: %s", job.chat_id, error)
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            "queue_depth": self.queued,
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "flood_waits": self.flood_waits,
+            "latency_p50": pct(0.5),
+            "latency_p95": pct(0.95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+    async def _report_loop(self):
+        last_sent = -1
+        while True:
+            await asyncio.sleep(self.report_interval)
+            # Idle per-chat buckets are back to full capacity and carry no state worth keeping.
+            for chat_id in [c for c, b in self._chat_buckets.items() if c not in self._chats and b.is_full()]:
+                del self._chat_buckets[chat_id]
+            stats = self.stats()
+            if stats["sent"] != last_sent or stats["queue_depth"]:
+                last_sent = stats["sent"]
+                logger.info("Outbox: depth=%(queue_depth)d in_flight=%(in_flight)d sent=%(sent)d "
+                            "failed=%(failed)d retries=%(retries)d flood_waits=%(flood_waits)d "
+                            "latency p50=%(latency_p50).3fs p95=%(latency_p95).3fs", stats)
+
+    async def close(self, timeout: float = 10.0):
+        """Delivers what is queued (up to ``timeout`` seconds) and stops the workers."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox closed with %d undelivered messages", self.queued)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,175 @@
+"""Survey sessions: a compact per-respondent record and idle-session housekeeping."""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from state_store import Namespace
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """Progress of one respondent through one survey version.
+
+    ``path`` holds the indices of the questions visited (the last one is current) and
+    ``answers`` the answer given at each position of ``path``, so question texts are never
+    copied into the session. After going back, ``ahead`` holds the questions stepped back
+    from (nearest last); their answers stay in ``answers`` until the respondent takes
+    another branch.
+    """
+
+    __slots__ = ("survey", "version", "path", "answers", "awaiting_answer", "updated_at", "reminded", "ahead")
+
+    def __init__(self, survey: Optional[str], version: Optional[int], path: Optional[list] = None,
+                 answers: Optional[list] = None, awaiting_answer: bool = True, updated_at: float = 0.0,
+                 reminded: bool = False, ahead: Optional[list] = None):
+        self.survey = survey
+        self.version = version
+        self.path = path or [0]
+        self.answers = answers if answers is not None else []
+        self.awaiting_answer = awaiting_answer
+        self.updated_at = updated_at
+        self.reminded = reminded
+        self.ahead = ahead or []
+
+    @property
+    def q_index(self) -> int:
+        return self.path[-1]
+
+    def dump(self) -> dict:
+        return {"s": self.survey, "v": self.version, "p": self.path, "a": self.answers,
+                "w": self.awaiting_answer, "t": self.updated_at, "r": self.reminded, "f": self.ahead}
+
+    @classmethod
+    def load(cls, data: dict) -> "Session":
+        if "p" in data:
+            return cls(data["s"], data["v"], data["p"], data["a"], data["w"], data["t"], data["r"], data.get("f"))
+        # Sessions stored as plain dicts, with (question, answer) pairs, by earlier releases.
+        answers = [a[1] if isinstance(a, (list, tuple)) else a for a in data.get("answers", [])]
+        return cls(data.get("survey"), data.get("version"), data.get("path") or [data.get("q_index", 0)],
+                   answers, data.get("awaiting_answer", True))
+
+
+class SessionManager:
+    """Live sessions kept in a state-store namespace, with idle expiry and a hard cap.
+
+    An in-memory index of user id -> last activity, oldest first, lets ``sweep`` stop at
+    the first session that is still fresh. A session idle for ``remind_after`` seconds is
+    passed to ``on_remind`` once; after ``ttl`` seconds idle, or when more than
+    ``max_sessions`` are live, the oldest sessions are passed to ``on_expire`` and deleted.
+    ``owns`` limits the manager to some user ids when several workers share one backend.
+    """
+
+    def __init__(self, namespace: Namespace, ttl: Optional[float] = None, max_sessions: Optional[int] = None,
+                 remind_after: Optional[float] = None,
+                 on_remind: Optional[Callable[[int, Session], Awaitable]] = None,
+                 on_expire: Optional[Callable[[int, Session, str], Awaitable]] = None,
+                 owns: Optional[Callable[[int], bool]] = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.remind_after = remind_after
+        self.on_remind = on_remind
+        self.on_expire = on_expire
+        self.owns = owns
+        self._index: OrderedDict[str, float] = OrderedDict()
+        self._reminded: set[str] = set()
+        self._evictions: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    async def start(self):
+        """Rebuilds the activity index from the sessions already in the backend."""
+        now = time.time()
+        entries = []
+        for key in await self.namespace.keys():
+            if self.owns and not self.owns(int(key)):
+                continue
+            session = await self.namespace.get(key)
+            if session is None:
+                continue
+            entries.append((session.updated_at or now, key))
+            if session.reminded:
+                self._reminded.add(key)
+        for updated_at, key in sorted(entries):
+            self._index[key] = updated_at
+        logger.info("Tracking %d survey sessions", len(self._index))
+
+    async def get(self, user_id) -> Optional[Session]:
+        return await self.namespace.get(user_id)
+
+    def put(self, user_id, session: Session):
+        """Stores the session and counts it as activity of the respondent."""
+        key = str(user_id)
+        session.updated_at = time.time()
+        session.reminded = False
+        self.namespace.put(key, session)
+        self._index[key] = session.updated_at
+        self._index.move_to_end(key)
+        self._reminded.discard(key)
+        if self.max_sessions and len(self._index) > self.max_sessions:
+            oldest, _ = self._index.popitem(last=False)
+            task = asyncio.create_task(self._expire(oldest, "cap"))
+            self._evictions.add(task)
+            task.add_done_callback(self._evictions.discard)
+
+    def delete(self, user_id):
+        key = str(user_id)
+        self.namespace.delete(key)
+        self._index.pop(key, None)
+        self._reminded.discard(key)
+
+    async def _expire(self, key: str, reason: str):
+        session = await self.namespace.get(key)
+        if key in self._index:
+            return  # the respondent came back while the session was being loaded
+        self.namespace.delete(key)
+        self._reminded.discard(key)
+        if session is not None and self.on_expire:
+            try:
+                await self.on_expire(int(key), session, reason)
+            except Exception:
+                logger.exception("Failed to handle expiry of session %s", key)
+
+    async def _remind(self, key: str):
+        session = await self.namespace.get(key)
+        if session is None:
+            self._index.pop(key, None)
+            return
+        self._reminded.add(key)
+        session.reminded = True
+        self.namespace.put(key, session)  # not activity: updated_at stays
+        if self.on_remind:
+            try:
+                await self.on_remind(int(key), session)
+            except Exception:
+                logger.exception("Failed to remind user %s", key)
+
+    async def sweep(self, now: Optional[float] = None) -> tuple[int, int]:
+        """Sends due reminders and expires idle sessions; returns (reminded, expired)."""
+        limits = [x for x in (self.ttl, self.remind_after) if x]
+        if not limits:
+            return 0, 0
+        now = now or time.time()
+        stale = []
+        for key, updated_at in self._index.items():
+            if now - updated_at < min(limits):
+                break
+            stale.append((key, now - updated_at))
+        reminded = expired = 0
+        for key, idle in stale:
+            if self.ttl and idle >= self.ttl:
+                self._index.pop(key, None)
+                await self._expire(key, "idle")
+                expired += 1
+            elif self.remind_after and idle >= self.remind_after and key not in self._reminded:
+                await self._remind(key)
+                reminded += 1
+        return reminded, expired
+
+    async def close(self):
+        if self._evictions:
+            await asyncio.gather(*self._evictions)
@@ -1,4 +1,6 @@
 import os
+import functools
+import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
@@ -6,102 +8,119 @@ from telegram.ext import (
 )
 from telegram.helpers import escape_markdown
 
+from state_store import store_from_env
+from dispatcher import PerUserUpdateProcessor
+from survey import NavLabels, SurveyRegistry
+from sessions import Session, SessionManager
+
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "8064625815:AAFJKTIk2iU8IDBrsrdabMLqEAya_l_9Coo"
 ADMIN_ID    = int(os.getenv("ADMIN_ID", "5601411156"))
 BUTTON_ADMIN_USERNAME = "Men_of_G" 
 
-greeting_text = (
-    "Привет! Я студент ММК, Богдан Толкачев, и я пишу проектную работу на тему зависимостей.\n\n"
-    "Я изучаю то, как зависимости формируются, и как можно помочь человеку с зависимостью.\n\n"
-    "Ваши ответы помогут более подробно раскрыть эту тему, постарайтесь быть как можно искренними, "
-    "и пишите всё, что считаете нужным — тут нет мелочей. Если у вас есть другие зависимости "
-    "(переедание/алкоголь), то можете написать о них — это действительно очень важно.\n\n"
-    "⬇️ Нажмите кнопку ниже, чтобы начать:"
+surveys = SurveyRegistry(
+    os.getenv("SURVEYS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "surveys")),
+    default_id=os.getenv("DEFAULT_SURVEY", "smoking"),
+    labels=NavLabels(back="⬅️ Back", next="➡️ Next", finish="✅ Finish"),
 )
+surveys.reload()
+CONTACT_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Связаться с админом", url=f"https://t.me/{BUTTON_ADMIN_USERNAME}")]])
 
-thank_you_text = (
-    "Спасибо большое за твоё время. Это маленький вклад в большое дело. "
-    "Дело, которое в дальнейшем, как я верю, спасёт не мало семей от разрушения 🙏"
-)
+session_store = store_from_env(os.getenv("STATE_DB_PATH", "smokebot_state.db"))
+user_states = session_store.namespace("user_states", decode=Session.load)
 
-questions = [
-    "1️⃣ Расскажи, пожалуйста, о том дне, когда ты впервые закурил. Что ты почувствовал? Какие мысли у тебя были во время этого?",
-    "2️⃣ Что ты чувствовал на следующий день?",
-    "3️⃣ Какие события произошли в твоей жизни до того, как к тебе в голову пришла идея попробовать закурить?",
-    "4️⃣ Расскажи, пожалуйста, обстановку в своей семье: часто ли ты чувствуешь напряжённую обстановку дома? Как твои отношения с родителями?",
-    "5️⃣ Как ты думаешь, твоя привычка курить связана с тем, что произошло в твоей жизни?",
-    "6️⃣ Почему ты продолжаешь курить? Доставляет ли тебе сейчас удовольствие твоя зависимость?",
-    "7️⃣ Если бы тебе предоставили возможность бросить зависимость, пройти терапию и разобраться в проблеме, ты бы согласился/лась?"
-]
+async def remind_session(bot, user_id: int, session: Session):
+    survey = surveys.for_session(session)
+    await bot.send_message(user_id, f"⏳ Вы не закончили опрос. Продолжим?\n\n{survey.current(session).text}")
 
-user_states: dict[int, dict] = {}
+sessions = SessionManager(
+    user_states,
+    ttl=float(os.getenv("SESSION_TTL", str(7 * 24 * 3600))) or None,
+    max_sessions=int(os.getenv("SESSION_MAX", "100000")) or None,
+    remind_after=float(os.getenv("SESSION_REMIND_AFTER", str(24 * 3600))) or None,
+)
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    reminded, expired = await sessions.sweep()
+    if reminded or expired:
+        logging.info("Session sweep: %d reminded, %d expired, %d live", reminded, expired, len(sessions))
 
 def _escape_md(text: str) -> str:
     return escape_markdown(text or "", version=2)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    kb = [[InlineKeyboardButton("Начать опрос", callback_data="start_survey")]]
-    await update.message.reply_text(greeting_text, reply_markup=InlineKeyboardMarkup(kb))
+    survey = (surveys.get(context.args[0]) if context.args else None) or surveys.get()
+    await update.message.reply_text(survey.greeting, reply_markup=survey.start_markup)
 
 async def start_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    user_states[uid] = {"q_index": 0, "answers": [], "awaiting_answer": True}
-    await query.edit_message_text(questions[0])
+    _, _, survey_id = query.data.partition(":")
+    survey = surveys.get(survey_id or None) or surveys.get()
+    sessions.put(uid, survey.new_session())
+    await query.edit_message_text(survey.questions[0].text)
 
 async def next_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     uid = query.from_user.id
-    state = user_states.get(uid)
-    if not state or state["awaiting_answer"]:
-        if state:
-            await query.answer("Сначала ответьте на текущий вопрос.", show_alert=True)
+    state = await sessions.get(uid)
+    if not state:
+        await query.answer()
+        return
+    survey = surveys.for_session(state)
+    if survey.current_answer(state) is None:
+        await query.answer("Сначала ответьте на текущий вопрос.", show_alert=True)
         return
-    if state["q_index"] + 1 < len(questions):
-        state["q_index"] += 1
-        state["awaiting_answer"] = True
-        await query.edit_message_text(questions[state["q_index"]])
+    await query.answer()
+    if survey.advance(state):
+        state.awaiting_answer = True
+        sessions.put(uid, state)
+        await query.edit_message_text(survey.current(state).text)
 
 async def back_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    state = user_states.get(uid)
-    if state and state["q_index"] > 0:
-        state["q_index"] -= 1
-        state["awaiting_answer"] = True
-        await query.edit_message_text(questions[state["q_index"]])
+    state = await sessions.get(uid)
+    if not state:
+        return
+    survey = surveys.for_session(state)
+    if survey.back(state):
+        state.awaiting_answer = True
+        sessions.put(uid, state)
+        await query.edit_message_text(survey.current(state).text)
 
 async def finish_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    user_states.pop(uid, None)
-    await query.edit_message_text(thank_you_text)
+    state = await sessions.get(uid)
+    survey = surveys.for_session(state) if state else surveys.get()
+    sessions.delete(uid)
+    await query.edit_message_text(survey.thank_you)
 
-    kb = [[InlineKeyboardButton("Связаться с админом", url=f"https://t.me/{BUTTON_ADMIN_USERNAME}")]]
     await context.bot.send_message(uid, "Если у вас есть вопросы, свяжитесь с админом:",
-                                   reply_markup=InlineKeyboardMarkup(kb))
+                                   reply_markup=CONTACT_MARKUP)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     text = update.message.text
-    state = user_states.get(uid)
+    state = await sessions.get(uid)
 
     if not state:
         await update.message.reply_text("Пожалуйста, начни с команды /start.")
         return
-    if not state["awaiting_answer"]:
+    if not state.awaiting_answer:
         return
 
-    q_idx = state["q_index"]
-    if len(state["answers"]) > q_idx:
-        state["answers"][q_idx] = (questions[q_idx], text)
-    else:
-        state["answers"].append((questions[q_idx], text))
-    state["awaiting_answer"] = False
+    survey = surveys.for_session(state)
+    question = survey.current(state)
+    error = survey.record_answer(state, text)
+    if error:
+        await update.message.reply_text(error)
+        return
+    state.awaiting_answer = False
+    sessions.put(uid, state)
 
     user = update.effective_user
     header_raw = f"{user.full_name} (@{user.username})" if user.username else user.full_name
@@ -109,37 +128,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     answer_md = (
         f"*Ответ пользователя* {header}\n"
-        f"*Вопрос:* {_escape_md(questions[q_idx])}\n"
+        f"*Вопрос:* {question.text_md}\n"
         f"*Ответ:* {_escape_md(text)}"
     )
     await context.bot.send_message(ADMIN_ID, answer_md, parse_mode="MarkdownV2")
 
-    buttons = []
-    if q_idx > 0:
-        buttons.append(InlineKeyboardButton("⬅️ Back", callback_data="back_question"))
-    if q_idx + 1 < len(questions):
-        buttons.append(InlineKeyboardButton("➡️ Next", callback_data="next_question"))
-    else:
-        buttons.append(InlineKeyboardButton("✅ Finish", callback_data="finish_survey"))
-
     await update.message.reply_text(
         "Спасибо за ответ. Вы можете перейти дальше или вернуться к предыдущему вопросу:",
-        reply_markup=InlineKeyboardMarkup([buttons])
+        reply_markup=survey.nav_markup(question.index, text)
     )
     
+async def post_init(app):
+    await session_store.start()
+    sessions.on_remind = functools.partial(remind_session, app.bot)
+    await sessions.start()
+    surveys.start_watching(float(os.getenv("SURVEY_RELOAD_INTERVAL", "5")))
+
+async def post_stop(app):
+    await surveys.stop_watching()
+
+async def post_shutdown(app):
+    await sessions.close()
+    await session_store.close()
+
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN env var is not set!")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder().token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(
+            max_concurrent_updates=int(os.getenv("MAX_CONCURRENT_UPDATES", "64")),
+            max_user_backlog=int(os.getenv("MAX_USER_BACKLOG", "20")),
+        ))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(start_survey, pattern="^start_survey$"))
+    app.add_handler(CallbackQueryHandler(start_survey, pattern="^start_survey(:|$)"))
     app.add_handler(CallbackQueryHandler(next_question,  pattern="^next_question$"))
     app.add_handler(CallbackQueryHandler(back_question,  pattern="^back_question$"))
     app.add_handler(CallbackQueryHandler(finish_survey, pattern="^finish_survey$"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+    interval = float(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+    app.job_queue.run_repeating(sweep_sessions, interval=interval, first=interval, name="session-sweep")
+
     if os.getenv("RENDER"):
         port = int(os.getenv("PORT", "10000"))
         public_url = os.getenv("RENDER_EXTERNAL_URL")
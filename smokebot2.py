@@ -1,15 +1,31 @@
 import os
+import asyncio
 import logging
-import sqlite3
-from typing import TypedDict, List, Tuple
+import re
+import tempfile
+from datetime import date
+from typing import Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 from telegram.helpers import escape_markdown
 
+from storage import HIGHLIGHT_END, HIGHLIGHT_START, MessageStore, fts_query
+from state_store import store_from_env
+from dispatcher import PerUserUpdateProcessor
+from outbox import Outbox, PRIORITY_ADMIN, PRIORITY_BULK
+from digest import DigestBuffer, MESSAGE_LIMIT
+from webhook import WebhookRouter, WebhookWorker, shard_for
+from export import FORMATS, export
+from survey import SurveyRegistry
+from sessions import Session, SessionManager
+from stats import SurveyStats
+from broadcast import Broadcasts
+import metrics
+
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "8064625815:AAFJKTIk2iU8IDBrsrdabMLqEAya_l_9Coo"
 admin_ids = [5601411156]
 ADMIN_USERNAME = "Men_of_G"
@@ -17,71 +33,128 @@ DB_PATH = "support_bot.db"
 
 logging.basicConfig(level=logging.INFO)
 
-class UserState(TypedDict):
-    q_index: int
-    answers: List[Tuple[str, str]]
-    awaiting_answer: bool
-
-user_states: dict[int, UserState] = {}
-pending_replies = {}
-survey_completed = set()
-allowed_retake = set()
-
-greeting_text = (
-    "Привет! Я студент ММК, Богдан Толкачев, и я пишу проектную работу на тему зависимостей.\n\n"
-    "Я изучаю то, как зависимости формируются, и как можно помочь человеку с зависимостью.\n\n"
-    "Ваши ответы помогут более подробно раскрыть эту тему, постарайтесь быть как можно искренними, "
-    "и пишите всё, что считаете нужным — тут нет мелочей. Если у вас есть другие зависимости "
-    "(переедание/алкоголь), то можете написать о них — это действительно очень важно.\n\n"
-    "⬇️ Нажмите кнопку ниже, чтобы начать:"
+def _shard_from_env():
+    # WEBHOOK_SHARD=<index>/<count> on each worker replica (SESSION_SHARD is the older name).
+    shard = os.getenv("WEBHOOK_SHARD") or os.getenv("SESSION_SHARD")
+    if not shard:
+        return None
+    index, count = (int(x) for x in shard.split("/"))
+    return index, count
+
+SHARD = _shard_from_env()
+
+session_store = store_from_env(DB_PATH)
+user_states = session_store.namespace("user_states", decode=Session.load)  # user_id -> Session
+pending_replies = session_store.namespace("pending_replies")  # admin_id -> target user_id
+# Granted on the admin's shard, read on the respondent's: cached entries (misses included)
+# go stale after SHARED_STATE_TTL seconds so other workers see the change.
+SHARED_STATE_TTL = float(os.getenv("SHARED_STATE_TTL", "5"))
+survey_completed = session_store.namespace("survey_completed", ttl=SHARED_STATE_TTL)  # "<survey_id>:<user_id>"
+allowed_retake = session_store.namespace("allowed_retake", ttl=SHARED_STATE_TTL)
+
+# Telegram's ~30 msg/s applies to the whole bot token, so replicas split it between them.
+# OUTBOX_GLOBAL_RATE, when set, is this process's share.
+outbox = Outbox(
+    workers=int(os.getenv("OUTBOX_WORKERS", "8")),
+    global_rate=float(os.getenv("OUTBOX_GLOBAL_RATE", str(30 / (SHARD[1] if SHARD else 1)))),
+    chat_rate=float(os.getenv("OUTBOX_CHAT_RATE", "1")),
 )
 
-thank_you_text = (
-    "Спасибо большое за твоё время. Это маленький вклад в большое дело. "
-    "Дело, которое в дальнейшем, как я верю, спасёт не мало семей от разрушения 🙏"
+surveys = SurveyRegistry(
+    os.getenv("SURVEYS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "surveys")),
+    default_id=os.getenv("DEFAULT_SURVEY", "smoking"),
+)
+surveys.reload()
+CONTACT_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Связаться с админом", url=f"https://t.me/{ADMIN_USERNAME}")]])
+
+# Opt-in: one consolidated message per respondent instead of one per answer.
+digest = DigestBuffer(
+    outbox, admin_ids,
+    idle_window=float(os.getenv("DIGEST_IDLE_SECONDS", "600")),
+    max_answers=int(os.getenv("DIGEST_MAX_ANSWERS", str(len(surveys.get())))),
+) if os.getenv("ADMIN_DIGEST") == "1" else None
+
+store = MessageStore(
+    DB_PATH,
+    batch_size=int(os.getenv("DB_BATCH_SIZE", "200")),
+    flush_interval=float(os.getenv("DB_FLUSH_INTERVAL", "0.05")),
 )
 
-questions = [
-    "1️⃣ Расскажи, пожалуйста, о том дне, когда ты впервые закурил. Что ты почувствовал?",
-    "2️⃣ Что ты чувствовал на следующий день?",
-    "3️⃣ Какие события произошли в твоей жизни до того, как к тебе в голову пришла идея попробовать закурить?",
-    "4️⃣ Расскажи, пожалуйста, обстановку в своей семье: часто ли ты чувствуешь напряжённую обстановку дома? Как твои отношения с родителями?",
-    "5️⃣ Как ты думаешь, твоя привычка курить связана с тем, что произошло в твоей жизни?",
-    "6️⃣ Почему ты продолжаешь курить? Доставляет ли тебе сейчас удовольствие твоя зависимость?",
-    "7️⃣ Если бы тебе предоставили возможность бросить зависимость, пройти терапию и разобраться в проблеме, ты бы согласился/лась?"
-]
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            from_admin BOOLEAN,
-            text TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def save_message(user_id: int, text: str, from_admin: bool):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT INTO messages (user_id, from_admin, text) VALUES (?, ?, ?)", (user_id, from_admin, text))
-    conn.commit()
-    conn.close()
-
-def get_users_with_messages():
-    conn = sqlite3.connect(DB_PATH)
-    rows = conn.execute("SELECT DISTINCT user_id FROM messages").fetchall()
-    conn.close()
-    return [r[0] for r in rows]
-
-def get_chat_history(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    rows = conn.execute("SELECT from_admin, text, timestamp FROM messages WHERE user_id = ? ORDER BY id", (user_id,)).fetchall()
-    conn.close()
-    return rows
+survey_stats = SurveyStats(store)
+
+broadcasts = Broadcasts(
+    store, outbox,
+    default_survey=surveys.default_id,
+    exclude=admin_ids,
+    chunk_size=int(os.getenv("BROADCAST_CHUNK_SIZE", "100")),
+    report_interval=float(os.getenv("BROADCAST_REPORT_INTERVAL", "60")),
+    lease=float(os.getenv("BROADCAST_LEASE", "300")),
+)
+
+def save_message(user_id: int, text: str, from_admin: bool, q_index: Optional[int] = None,
+                 survey_id: Optional[str] = None):
+    store.save_message(user_id, text, from_admin, q_index, survey_id)
+
+metrics.gauge("bot_active_sessions", "Respondents with a survey in progress.", fn=lambda: len(sessions))
+metrics.gauge("bot_pending_admin_replies", "Admins who pressed reply and have not sent it yet.",
+              fn=lambda: _namespace_size(pending_replies))
+metrics.gauge("bot_db_queue_depth", "Writes waiting for the SQLite writer.", fn=lambda: store.queue_depth)
+metrics.gauge("bot_outbox_queue_depth", "Messages waiting in the outbox.", fn=lambda: outbox.queued)
+metrics.gauge("bot_outbox_in_flight", "Outbox sends in progress.", fn=lambda: outbox.in_flight)
+metrics.counter("bot_outbox_sent_total", "Messages delivered by the outbox.", fn=lambda: outbox.sent)
+metrics.counter("bot_outbox_failed_total", "Messages the outbox gave up on.", fn=lambda: outbox.failed)
+metrics.counter("bot_outbox_flood_waits_total", "RetryAfter responses seen by the outbox.",
+                fn=lambda: outbox.flood_waits)
+metrics.gauge("bot_broadcasts_running", "Broadcasts being delivered by this process.", fn=lambda: broadcasts.running)
+
+# PROFILE_HZ=<n> samples the event loop's stack n times a second, served on /debug/profile.
+profiler = metrics.SamplingProfiler(float(os.environ["PROFILE_HZ"])) if os.getenv("PROFILE_HZ") else None
+metrics_server = None
+
+async def _namespace_size(namespace) -> int:
+    return len(await namespace.keys())
+
+async def remind_session(user_id: int, session: Session):
+    survey = surveys.for_session(session)
+    outbox.send_message(user_id, f"⏳ Вы не закончили опрос. Продолжим?\n\n{survey.current(session).text}",
+                        priority=PRIORITY_BULK)
+
+async def expire_session(user_id: int, session: Session, reason: str):
+    survey = surveys.for_session(session)
+    survey_stats.abandoned(user_id, survey.id, session.q_index)
+    # Answers are saved as they arrive; this records where the respondent stopped.
+    if os.getenv("SESSION_SAVE_PARTIAL", "1") == "1" and session.answers:
+        answers = [(survey.questions[i].id, answer) for i, answer in zip(session.path, session.answers)]
+        store.save_abandoned(user_id, survey.id, survey.version, answers, reason)
+
+def _owns_from_env():
+    # A worker replica only manages the sessions of the users routed to it.
+    if not SHARD:
+        return None
+    index, count = SHARD
+    return lambda user_id: shard_for(user_id, count) == index
+
+sessions = SessionManager(
+    user_states,
+    ttl=float(os.getenv("SESSION_TTL", str(7 * 24 * 3600))) or None,
+    max_sessions=int(os.getenv("SESSION_MAX", "100000")) or None,
+    remind_after=float(os.getenv("SESSION_REMIND_AFTER", str(24 * 3600))) or None,
+    on_remind=remind_session,
+    on_expire=expire_session,
+    owns=_owns_from_env(),
+)
+
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+    # Picks up broadcasts whose owner died without releasing them (replicas share DB_PATH).
+    await broadcasts.resume()
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    reminded, expired = await sessions.sweep()
+    if reminded or expired:
+        logging.info("Session sweep: %d reminded, %d expired, %d live", reminded, expired, len(sessions))
+
+USERS_PAGE_SIZE = 10
+HISTORY_PAGE_SIZE = 20
 
 def _escape_md(text: str) -> str:
     return escape_markdown(text or "", version=2)
@@ -91,138 +164,439 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id in admin_ids:
         await update.message.reply_text("👋 Привет, админ! Используй /users для просмотра чатов.")
         return
-    if user_id in survey_completed and user_id not in allowed_retake:
+    # Deep link: t.me/<bot>?start=<survey_id>
+    survey = (surveys.get(context.args[0]) if context.args else None) or surveys.get()
+    if await survey_completed.contains(f"{survey.id}:{user_id}") and not await allowed_retake.contains(user_id):
         await update.message.reply_text("Вы уже проходили опрос. Обратитесь к администратору, чтобы пройти снова.")
         return
-    keyboard = [[InlineKeyboardButton("Начать опрос", callback_data="start_survey")]]
-    await update.message.reply_text(greeting_text, reply_markup=InlineKeyboardMarkup(keyboard))
-    save_message(user_id, update.message.text or "/start", from_admin=False)
+    broadcasts.unblock(user_id)
+    await update.message.reply_text(survey.greeting, reply_markup=survey.start_markup)
+    save_message(user_id, update.message.text or "/start", from_admin=False, survey_id=survey.id)
 
 async def start_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    if user_id in survey_completed and user_id not in allowed_retake:
-        await context.bot.send_message(user_id, "Вы уже завершили опрос. Администратор должен разрешить повтор.")
-        return
-    user_states[user_id] = {"q_index": 0, "answers": [], "awaiting_answer": True}
-    await context.bot.send_message(chat_id=user_id, text=questions[0])
+    _, _, survey_id = query.data.partition(":")
+    survey = surveys.get(survey_id or None) or surveys.get()
+    if await survey_completed.contains(f"{survey.id}:{user_id}"):
+        if not await allowed_retake.contains(user_id):
+            outbox.send_message(user_id, "Вы уже завершили опрос. Администратор должен разрешить повтор.")
+            return
+        allowed_retake.delete(user_id)  # one retake per permission
+    store.supersede_answers(user_id, survey.id)  # a retake starts a fresh row in exports
+    sessions.put(user_id, survey.new_session())
+    survey_stats.started(user_id, survey.id)
+    outbox.send_message(user_id, survey.questions[0].text)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
 
-    if user_id in admin_ids and user_id in pending_replies:
-        target_id = pending_replies.pop(user_id)
+    if user_id in admin_ids and await pending_replies.contains(user_id):
+        target_id = await pending_replies.pop(user_id)
         save_message(target_id, text, from_admin=True)
-        await context.bot.send_message(chat_id=target_id, text=f"💬 Ответ от администратора:\n\n{text}")
+        await outbox.send_message(target_id, f"💬 Ответ от администратора:\n\n{text}")
         await update.message.reply_text("✅ Ответ отправлен.")
         return
 
-    if user_id not in user_states:
+    state = await sessions.get(user_id)
+    if state is None:
         await update.message.reply_text("Пожалуйста, начни с команды /start.")
         return
 
-    state = user_states[user_id]
-    if not state["awaiting_answer"]:
+    if not state.awaiting_answer:
         return
 
-    q_index = state["q_index"]
-    question = questions[q_index]
-
-    if len(state["answers"]) > q_index:
-        state["answers"][q_index] = (question, text)
-    else:
-        state["answers"].append((question, text))
+    survey = surveys.for_session(state)
+    question = survey.current(state)
+    first = survey.current_answer(state) is None
+    error = survey.record_answer(state, text)
+    if error:
+        await update.message.reply_text(error)
+        return
 
-    save_message(user_id, text, from_admin=False)
-    state["awaiting_answer"] = False
+    save_message(user_id, text, from_admin=False, q_index=question.index, survey_id=survey.id)
+    survey_stats.answered(user_id, survey.id, question.index, len(text), first)
+    sessions.put(user_id, state)
 
     user = update.effective_user
     header = f"{user.full_name} (@{user.username})" if user.username else user.full_name
-    message_md = (
-        f"*Ответ пользователя* {_escape_md(header)}\n"
-        f"*Вопрос:* {_escape_md(question)}\n"
-        f"*Ответ:* {_escape_md(text)}"
-    )
-
-    for admin_id in admin_ids:
-        await context.bot.send_message(admin_id, message_md, parse_mode="MarkdownV2")
-
-    buttons = []
-    if q_index > 0:
-        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data="back_question"))
-    if q_index + 1 < len(questions):
-        buttons.append(InlineKeyboardButton("➡️ Далее", callback_data="next_question"))
+    if digest:
+        digest.add(user_id, header, question.text_md, text)
     else:
-        buttons.append(InlineKeyboardButton("✅ Завершить", callback_data="finish_survey"))
+        message_md = (
+            f"*Ответ пользователя* {_escape_md(header)}\n"
+            f"*Вопрос:* {question.text_md}\n"
+            f"*Ответ:* {_escape_md(text)}"
+        )
+        for admin_id in admin_ids:
+            outbox.send_message(admin_id, message_md, priority=PRIORITY_ADMIN, parse_mode="MarkdownV2")
 
-    reply_markup = InlineKeyboardMarkup([buttons])
-    await context.bot.send_message(chat_id=user_id, text=questions[state["q_index"]], reply_markup=reply_markup)
-    state["awaiting_answer"] = True
+    outbox.send_message(user_id, question.text, reply_markup=survey.nav_markup(question.index, text))
 
 async def next_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     uid = query.from_user.id
-    state = user_states.get(uid)
-    if not state or state["awaiting_answer"]:
-        if state:
-            await query.answer("Сначала ответьте на текущий вопрос.", show_alert=True)
+    state = await sessions.get(uid)
+    if not state:
+        await query.answer()
         return
-    if state["q_index"] + 1 < len(questions):
-        state["q_index"] += 1
-        state["awaiting_answer"] = True
-        await query.edit_message_text(questions[state["q_index"]])
+    survey = surveys.for_session(state)
+    if survey.current_answer(state) is None:
+        await query.answer("Сначала ответьте на текущий вопрос.", show_alert=True)
+        return
+    await query.answer()
+    answered = survey.answered_indices(state)
+    if survey.advance(state):
+        # Answers along the branch left behind must not end up in exports.
+        store.supersede_answers(uid, survey.id, set(answered) - set(survey.answered_indices(state)))
+        state.awaiting_answer = True
+        sessions.put(uid, state)
+        await query.edit_message_text(survey.current(state).text)
 
 async def back_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    state = user_states.get(uid)
-    if state and state["q_index"] > 0:
-        state["q_index"] -= 1
-        state["awaiting_answer"] = True
-        await query.edit_message_text(questions[state["q_index"]])
+    state = await sessions.get(uid)
+    if not state:
+        return
+    survey = surveys.for_session(state)
+    if survey.back(state):
+        state.awaiting_answer = True
+        sessions.put(uid, state)
+        await query.edit_message_text(survey.current(state).text)
 
 async def finish_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    user_states.pop(uid, None)
-    survey_completed.add(uid)
-    await query.edit_message_text(thank_you_text)
-    kb = [[InlineKeyboardButton("Связаться с админом", url=f"https://t.me/{ADMIN_USERNAME}")]]
-    await context.bot.send_message(uid, "Если у вас есть вопросы, свяжитесь с админом:", reply_markup=InlineKeyboardMarkup(kb))
+    state = await sessions.get(uid)
+    survey = surveys.for_session(state) if state else surveys.get()
+    sessions.delete(uid)
+    if state:
+        survey_stats.finished(uid, survey.id)
+    survey_completed.add(f"{survey.id}:{uid}")
+    if digest:
+        digest.flush(uid)
+    await query.edit_message_text(survey.thank_you)
+    outbox.send_message(uid, "Если у вас есть вопросы, свяжитесь с админом:", reply_markup=CONTACT_MARKUP)
+
+def _users_markup(rows, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    keyboard = [[InlineKeyboardButton(f"Пользователь {uid} ({count})", callback_data=f"view_{uid}")]
+                for uid, _, count in rows]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"users_p_{rows[0][1]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️ Далее", callback_data=f"users_n_{rows[-1][1]}"))
+    if nav:
+        keyboard.append(nav)
+    return InlineKeyboardMarkup(keyboard)
 
 async def users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in admin_ids:
         return
-    users = get_users_with_messages()
-    if not users:
+    rows, has_next = await store.users_page(limit=USERS_PAGE_SIZE)
+    if not rows:
         await update.message.reply_text("Нет активных пользователей.")
         return
-    keyboard = [[InlineKeyboardButton(f"Пользователь {uid}", callback_data=f"view_{uid}")] for uid in users]
-    await update.message.reply_text("Выберите пользователя:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text("Выберите пользователя:", reply_markup=_users_markup(rows, False, has_next))
 
-async def view_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    uid = int(query.data.split("_")[1])
-    rows = get_chat_history(uid)
-    lines = [f"{'👨‍💻 Админ' if from_admin else '👤 Пользователь'}: {text}" for from_admin, text, _ in rows]
-    text = "\n\n".join(lines) or "История пуста."
-    keyboard = [
+    if query.from_user.id not in admin_ids:
+        return
+    _, direction, cursor = query.data.split("_")
+    backward = direction == "p"
+    rows, has_more = await store.users_page(int(cursor), backward=backward, limit=USERS_PAGE_SIZE)
+    if not rows:
+        return
+    has_prev, has_next = (has_more, True) if backward else (True, has_more)
+    await query.edit_message_reply_markup(_users_markup(rows, has_prev, has_next))
+
+def _utf16_len(text: str) -> int:
+    # Telegram counts message length in UTF-16 code units: emoji outside the BMP take two.
+    return len(text.encode("utf-16-le")) // 2
+
+def _history_entry(from_admin, text: str, budget: int) -> str:
+    entry = f"{'👨‍💻 Админ' if from_admin else '👤 Пользователь'}: {text}"
+    if _utf16_len(entry) <= budget:
+        return entry
+    # Cut on a code unit boundary; "ignore" drops a surrogate pair split in half.
+    return entry.encode("utf-16-le")[:(budget - 1) * 2].decode("utf-16-le", "ignore") + "…"
+
+def _pack_history(uid: int, rows, backward: bool):
+    """Fits as many rows as possible into one message, keeping the ones nearest the cursor."""
+    header = f"🗂 История с {uid}:\n\n"
+    budget = MESSAGE_LIMIT - _utf16_len(header)
+    entries = []
+    for _id, from_admin, text, _ in (reversed(rows) if backward else rows):
+        entry = _history_entry(from_admin, text, budget - 2)
+        size = _utf16_len(entry) + 2
+        if entries and size > budget:
+            break
+        entries.append((_id, entry))
+        budget -= size
+    if backward:
+        entries.reverse()
+    return header + "\n\n".join(e for _, e in entries), entries[0][0], entries[-1][0], len(entries) < len(rows)
+
+def _history_markup(uid: int, first_id, last_id, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    keyboard = []
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"hist_{uid}_p_{first_id}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️ Далее", callback_data=f"hist_{uid}_n_{last_id}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard += [
         [InlineKeyboardButton("✉️ Ответить", callback_data=f"reply_{uid}")],
         [InlineKeyboardButton("♻️ Разрешить повтор", callback_data=f"allow_{uid}")]
     ]
-    await query.message.reply_text(f"🗂 История с {uid}:\n\n{text}", reply_markup=InlineKeyboardMarkup(keyboard))
+    return InlineKeyboardMarkup(keyboard)
+
+async def view_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    uid = int(query.data.split("_")[1])
+    rows, has_next = await store.history_page(uid, limit=HISTORY_PAGE_SIZE)
+    if not rows:
+        await query.message.reply_text(f"🗂 История с {uid}:\n\nИстория пуста.",
+                                       reply_markup=_history_markup(uid, None, None, False, False))
+        return
+    text, first_id, last_id, trimmed = _pack_history(uid, rows, backward=False)
+    markup = _history_markup(uid, first_id, last_id, False, has_next or trimmed)
+    await query.message.reply_text(text, reply_markup=markup)
+
+async def history_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in admin_ids:
+        return
+    _, uid, direction, cursor = query.data.split("_")
+    uid, backward = int(uid), direction == "p"
+    rows, has_more = await store.history_page(uid, int(cursor), backward=backward, limit=HISTORY_PAGE_SIZE)
+    if not rows:
+        return
+    text, first_id, last_id, trimmed = _pack_history(uid, rows, backward)
+    has_more = has_more or trimmed
+    has_prev, has_next = (has_more, True) if backward else (True, has_more)
+    await query.edit_message_text(text, reply_markup=_history_markup(uid, first_id, last_id, has_prev, has_next))
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in admin_ids:
+        return
+    fmt = context.args[0].lower() if context.args else "csv"
+    survey = surveys.get(context.args[1]) if len(context.args) > 1 else surveys.get()
+    if fmt not in FORMATS or survey is None:
+        await update.message.reply_text(f"/export [{' | '.join(FORMATS)}] [{' | '.join(surveys.ids())}]")
+        return
+    await store.flush()
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(export, DB_PATH, path, fmt, len(survey),
+                                        survey_id=survey.id, untagged_survey=surveys.default_id)
+        with open(path, "rb") as fp:
+            await update.message.reply_document(fp, filename=f"{survey.id}.{fmt}",
+                                                caption=f"📤 Респондентов: {count}")
+    except RuntimeError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+    finally:
+        os.remove(path)
+
+SEARCH_PAGE_SIZE = 5
+SEARCH_SNIPPET_LIMIT = 400
+SEARCH_USAGE = (
+    "/search <запрос> [q:N] [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД]\n"
+    "Ищутся все слова сразу; \"фраза\" — целиком, слово* — по началу слова, OR — любое из двух."
+)
+_SEARCH_FILTER = re.compile(r"(?<!\S)(q|from|to):(\S+)")
+
+def _parse_search(text: str) -> Optional[dict]:
+    opts = dict(_SEARCH_FILTER.findall(text))
+    try:
+        q_index = int(opts["q"]) - 1 if "q" in opts else None
+        for key in ("from", "to"):
+            if key in opts:
+                date.fromisoformat(opts[key])
+    except ValueError:
+        return None
+    match = fts_query(_SEARCH_FILTER.sub(" ", text))
+    if not match or (q_index is not None and q_index < 0):
+        return None
+    return {"match": match, "q_index": q_index, "date_from": opts.get("from"), "date_to": opts.get("to")}
+
+def _snippet_md(snippet: str) -> str:
+    snippet = snippet[:SEARCH_SNIPPET_LIMIT]
+    if snippet.count(HIGHLIGHT_START) > snippet.count(HIGHLIGHT_END):
+        snippet += HIGHLIGHT_END
+    return _escape_md(snippet).replace(HIGHLIGHT_START, "*").replace(HIGHLIGHT_END, "*")
+
+async def _search_results(params: dict, offset: int):
+    rows, has_next = await store.search(**params, offset=offset, limit=SEARCH_PAGE_SIZE)
+    if not rows:
+        return _escape_md("🔍 Ничего не найдено."), None
+    entries = []
+    for _id, uid, q_index, timestamp, snippet in rows:
+        where = f"вопрос {q_index + 1}" if q_index is not None else "сообщение"
+        entries.append(f"👤 `{uid}` · {_escape_md(f'{where} · {timestamp[:16]}')}\n{_snippet_md(snippet)}")
+    header = _escape_md(f"🔍 Результаты {offset + 1}–{offset + len(rows)}:")
+    keyboard = [[InlineKeyboardButton(f"👤 {uid}", callback_data=f"view_{uid}")]
+                for uid in dict.fromkeys(row[1] for row in rows)]
+    nav = []
+    if offset:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search_{max(offset - SEARCH_PAGE_SIZE, 0)}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️ Далее", callback_data=f"search_{offset + SEARCH_PAGE_SIZE}"))
+    if nav:
+        keyboard.append(nav)
+    return header + "\n\n" + "\n\n".join(entries), InlineKeyboardMarkup(keyboard)
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in admin_ids:
+        return
+    if not store.fts:
+        await update.message.reply_text("⚠️ Поиск недоступен: SQLite собран без FTS5.")
+        return
+    params = _parse_search(update.message.text.partition(" ")[2])
+    if params is None:
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+    context.user_data["search"] = params
+    text, markup = await _search_results(params, 0)
+    await update.message.reply_text(text, parse_mode="MarkdownV2", reply_markup=markup)
+
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in admin_ids:
+        return
+    params = context.user_data.get("search")
+    if params is None:
+        await query.edit_message_text("Поиск устарел, повторите /search.")
+        return
+    text, markup = await _search_results(params, int(query.data.split("_")[1]))
+    await query.edit_message_text(text, parse_mode="MarkdownV2", reply_markup=markup)
+
+def _percent(part: int, whole: int) -> str:
+    return f"{part / whole:.0%}" if whole else "—"
+
+def _stats_text(survey, snapshot: dict) -> str:
+    started, finished = snapshot["started"], snapshot["finished"]
+    median = snapshot["median_length"]
+    lines = [
+        f"📊 Опрос {survey.id}",
+        f"Начали: {started} · Завершили: {finished} ({_percent(finished, started)}) · "
+        f"Брошено: {snapshot['abandoned']}",
+        f"Медиана длины ответа: {median:.0f} симв." if median is not None else "Ответов пока нет.",
+    ]
+    questions = snapshot["questions"]
+    drops = [(a["reached"] - b["reached"], a["q_index"]) for a, b in zip(questions, questions[1:])]
+    if drops and max(drops)[0] > 0:
+        drop, q_index = max(drops)
+        lines.append(f"Наибольший отсев: после вопроса {q_index + 1} (−{drop})")
+    if questions:
+        lines.append("\nПо вопросам (дошли · ответов · медиана длины):")
+        for q in questions:
+            median = f"{q['median_length']:.0f}" if q["median_length"] is not None else "—"
+            lines.append(f"{q['q_index'] + 1}. {q['reached']} ({_percent(q['reached'], started)}) · "
+                         f"{q['answers']} · {median}")
+    if snapshot["daily"]:
+        lines.append("\nПо дням (начали · ответов · завершили · брошено):")
+        for day in snapshot["daily"]:
+            lines.append(f"{day['day']}: {day['started']} · {day['answers']} · {day['finished']} · {day['abandoned']}")
+    return "\n".join(lines)
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in admin_ids:
+        return
+    if context.args and context.args[0] == "rebuild":
+        events = await survey_stats.rebuild(surveys.default_id)
+        await update.message.reply_text(f"♻️ Статистика пересчитана по {events} событиям.")
+        return
+    survey = surveys.get(context.args[0]) if context.args else surveys.get()
+    if survey is None:
+        await update.message.reply_text(f"/stats [{' | '.join(surveys.ids())} | rebuild]")
+        return
+    await update.message.reply_text(_stats_text(survey, await survey_stats.snapshot(survey.id)))
+
+BROADCAST_USAGE = (
+    "/broadcast <кому> <текст>\n"
+    "кому:\n"
+    "all — все, кто писал боту\n"
+    "abandoned[:опрос] — начали опрос и не закончили (неактивны больше суток)\n"
+    "answered:N[:слова][@опрос] — ответили на вопрос N опроса (ответ содержит слова, через +)"
+)
+BROADCAST_STATUS = {"draft": "черновик", "running": "идёт", "done": "завершена", "cancelled": "отменена"}
+
+def _broadcast_text(b: dict) -> str:
+    done = b["sent"] + b["failed"] + b["blocked"]
+    line = (f"#{b['id']} {b['selector']} · {BROADCAST_STATUS.get(b['status'], b['status'])} · "
+            f"{done}/{b['total']} ({_percent(done, b['total'])}), ошибок {b['failed']}, "
+            f"заблокировали {b['blocked']}")
+    if b["elapsed"]:
+        line += f" · {done / b['elapsed']:.1f} сообщ./с"
+    return line
+
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in admin_ids:
+        return
+    parts = update.message.text.partition(" ")[2].strip().split(None, 1)
+    if len(parts) < 2:
+        await update.message.reply_text(BROADCAST_USAGE)
+        return
+    selector, text = parts
+    try:
+        broadcast_id, total = await broadcasts.create(update.effective_user.id, selector, text)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}\n\n{BROADCAST_USAGE}")
+        return
+    markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Отправить", callback_data=f"bc_go_{broadcast_id}"),
+        InlineKeyboardButton("✖️ Отмена", callback_data=f"bc_cancel_{broadcast_id}"),
+    ]]) if total else None
+    await update.message.reply_text(f"📣 Рассылка #{broadcast_id}: получателей {total}.\n\n{text}",
+                                    reply_markup=markup)
+
+async def broadcasts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in admin_ids:
+        return
+    recent = await broadcasts.recent()
+    if not recent:
+        await update.message.reply_text("Рассылок ещё не было.")
+        return
+    keyboard = [[InlineKeyboardButton(f"⏹ Остановить #{b['id']}", callback_data=f"bc_stop_{b['id']}")]
+                for b in recent if b["status"] == "running"]
+    await update.message.reply_text("📣 Рассылки:\n" + "\n".join(_broadcast_text(b) for b in recent),
+                                    reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+
+async def broadcast_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in admin_ids:
+        return
+    _, action, broadcast_id = query.data.split("_")
+    broadcast_id = int(broadcast_id)
+    if action == "go":
+        done = await broadcasts.launch(broadcast_id)
+        text = f"🚀 Рассылка #{broadcast_id} запущена. Ход — в /broadcasts."
+    else:
+        done = await broadcasts.cancel(broadcast_id)
+        text = f"✖️ Рассылка #{broadcast_id} отменена."
+    if not done:
+        text = f"Рассылка #{broadcast_id} уже запущена или завершена."
+    await query.edit_message_text(text)
 
 async def prepare_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = int(query.data.split("_")[1])
-    pending_replies[query.from_user.id] = uid
+    pending_replies.put(query.from_user.id, uid)
     await query.message.reply_text("✍️ Напишите сообщение для пользователя:")
 
 async def allow_retake(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -241,21 +615,118 @@ async def handle_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "finish_survey":
         await finish_survey(update, context)
 
-def main():
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def post_init(app):
+    global metrics_server
+    if profiler:
+        profiler.start()
+    # /metrics and /debug/profile get their own listener, local by default, in every mode.
+    if os.getenv("METRICS_PORT"):
+        metrics_server = metrics.serve(int(os.environ["METRICS_PORT"]), os.getenv("METRICS_LISTEN", "127.0.0.1"),
+                                       profiler=profiler)
+    await store.start()
+    await survey_stats.start(surveys.default_id)
+    await session_store.start()
+    await sessions.start()
+    await outbox.start(app.bot)
+    await broadcasts.start()
+    surveys.start_watching(float(os.getenv("SURVEY_RELOAD_INTERVAL", "5")))
+
+async def post_stop(app):
+    await surveys.stop_watching()
+    if digest:
+        digest.flush_all()
+    await broadcasts.close()
+    await outbox.close()
+
+async def post_shutdown(app):
+    if metrics_server:
+        metrics_server.stop()
+    if profiler:
+        profiler.stop()
+    await sessions.close()
+    await session_store.close()
+    await store.close()
+
+def build_app():
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if os.getenv("BOT_API_URL"):  # self-hosted Bot API server, or the benchmark's fake one
+        builder = builder.base_url(f"{os.environ['BOT_API_URL'].rstrip('/')}/bot")
+    app = (
+        builder
+        .request(metrics.InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(
+            max_concurrent_updates=int(os.getenv("MAX_CONCURRENT_UPDATES", "64")),
+            max_user_backlog=int(os.getenv("MAX_USER_BACKLOG", "20")),
+        ))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("users", users_cmd))
+    app.add_handler(CommandHandler("export", export_cmd))
+    app.add_handler(CommandHandler("search", search_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("broadcast", broadcast_cmd))
+    app.add_handler(CommandHandler("broadcasts", broadcasts_cmd))
     app.add_handler(MessageHandler(filters.TEXT, handle_message))
 
-    app.add_handler(CallbackQueryHandler(start_survey, pattern="^start_survey$"))
+    app.add_handler(CallbackQueryHandler(start_survey, pattern="^start_survey(:|$)"))
     app.add_handler(CallbackQueryHandler(handle_navigation, pattern="^(next_question|back_question|finish_survey)$"))
     app.add_handler(CallbackQueryHandler(view_messages, pattern="^view_"))
+    app.add_handler(CallbackQueryHandler(users_page, pattern="^users_[np]_"))
+    app.add_handler(CallbackQueryHandler(history_page, pattern="^hist_"))
+    app.add_handler(CallbackQueryHandler(search_page, pattern="^search_\\d+$"))
     app.add_handler(CallbackQueryHandler(prepare_reply, pattern="^reply_"))
     app.add_handler(CallbackQueryHandler(allow_retake, pattern="^allow_"))
+    app.add_handler(CallbackQueryHandler(broadcast_action, pattern="^bc_(go|cancel|stop)_\\d+$"))
+    metrics.instrument_handlers(app)
+
+    interval = float(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+    app.job_queue.run_repeating(sweep_sessions, interval=interval, first=interval, name="session-sweep")
+    app.job_queue.run_repeating(resume_broadcasts, interval=broadcasts.lease, first=broadcasts.lease,
+                                name="broadcast-resume")
+    return app
+
+async def _serve_router(router: WebhookRouter, port: int, webhook_url: Optional[str]):
+    server = None
+    if os.getenv("METRICS_PORT"):
+        server = metrics.serve(int(os.environ["METRICS_PORT"]), os.getenv("METRICS_LISTEN", "127.0.0.1"))
+    try:
+        await router.serve("0.0.0.0", port, bot=Bot(BOT_TOKEN), webhook_url=webhook_url)
+    finally:
+        if server:
+            server.stop()
 
-    app.run_polling()
+def main():
+    # WEBHOOK_ROLE=router: shard incoming updates by user id across WEBHOOK_WORKERS.
+    # WEBHOOK_ROLE=worker: serve one shard; with WEBHOOK_URL set it registers the webhook itself.
+    # Give every worker WEBHOOK_SHARD=<index>/<count>, matching its place in WEBHOOK_WORKERS.
+    # Survey state must live in a backend every worker reaches (STATE_BACKEND=redis, or one
+    # shared STATE_DB_PATH on one host). Each worker caches it: sessions are only touched by
+    # their own shard, allowed_retake/survey_completed expire after SHARED_STATE_TTL, and
+    # STATE_CACHE_TTL bounds everything else.
+    # The message log (DB_PATH) is a local SQLite file: the admin views (/users, /search,
+    # /export, /stats, /broadcast) only see every shard's messages when all workers run on
+    # one host and share that file; workers on separate hosts each see only their own shard.
+    role = os.getenv("WEBHOOK_ROLE")
+    port = int(os.getenv("PORT", "8080"))
+    url_path = os.getenv("WEBHOOK_PATH", "/webhook")
+    secret = os.getenv("WEBHOOK_SECRET")
+    public_url = os.getenv("WEBHOOK_URL")
+    webhook_url = f"{public_url}{url_path}" if public_url else None
+
+    if role == "router":
+        workers = [u.strip().rstrip("/") for u in os.environ["WEBHOOK_WORKERS"].split(",") if u.strip()]
+        router = WebhookRouter(workers, url_path=url_path, secret_token=secret)
+        asyncio.run(_serve_router(router, port, webhook_url))
+    elif role == "worker":
+        worker = WebhookWorker(build_app(), url_path=url_path, secret_token=secret)
+        asyncio.run(worker.serve("0.0.0.0", port, webhook_url=webhook_url))
+    else:
+        build_app().run_polling()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,426 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+def _encode(value):
+    # Objects that know their JSON form (e.g. ``sessions.Session``) are stored through it.
+    dump = getattr(value, "dump", None)
+    if dump is None:
+        raise TypeError(f"Cannot store {type(value).__name__} in the state store")
+    return dump()
+
+
+class StateBackend(ABC):
+    """Durable key/value storage for survey state. Values are JSON strings, ``None`` deletes."""
+
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def get(self, ns: str, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set_many(self, items: Iterable[tuple[str, str, Optional[str]]]):
+        ...
+
+    @abstractmethod
+    async def keys(self, ns: str) -> list[str]:
+        ...
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    def __init__(self):
+        self._data: dict[tuple[str, str], str] = {}
+
+    async def get(self, ns, key):
+        return self._data.get((ns, key))
+
+    async def set_many(self, items):
+        for ns, key, value in items:
+            if value is None:
+                self._data.pop((ns, key), None)
+            else:
+                self._data[(ns, key)] = value
+
+    async def keys(self, ns):
+        return [k for n, k in self._data if n == ns]
+
+
+class SQLiteBackend(StateBackend):
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                ns TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (ns, key)
+            ) WITHOUT ROWID
+        """)
+        conn.commit()
+        self._conn = conn
+
+    async def start(self):
+        await self._run(self._connect)
+
+    async def get(self, ns, key):
+        row = await self._run(lambda: self._conn.execute(
+            "SELECT value FROM state WHERE ns = ? AND key = ?", (ns, key)).fetchone())
+        return row[0] if row else None
+
+    def _set_many(self, items):
+        with self._conn:
+            for ns, key, value in items:
+                if value is None:
+                    self._conn.execute("DELETE FROM state WHERE ns = ? AND key = ?", (ns, key))
+                else:
+                    self._conn.execute(
+                        "INSERT INTO state (ns, key, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value",
+                        (ns, key, value))
+
+    async def set_many(self, items):
+        await self._run(self._set_many, list(items))
+
+    async def keys(self, ns):
+        rows = await self._run(lambda: self._conn.execute(
+            "SELECT key FROM state WHERE ns = ?", (ns,)).fetchall())
+        return [r[0] for r in rows]
+
+    async def close(self):
+        if self._conn:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+class RedisError(RuntimeError):
+    pass
+
+
+class RedisBackend(StateBackend):
+    """Minimal RESP2 client: one hash per namespace. Works with Redis, KeyDB, Valkey or any
+    local server speaking the protocol (tests run it against ``tests/fake_redis.py``)."""
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "smokebot:"):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    async def _read_reply(self):
+        """Reads one reply; error replies are returned as ``RedisError`` so a pipeline can
+        read every reply before raising."""
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            return RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            if size < 0:
+                return None
+            data = await self._reader.readexactly(size + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            size = int(payload)
+            if size < 0:
+                return None
+            return [await self._read_reply() for _ in range(size)]
+        raise RedisError(f"Unexpected Redis reply: {line!r}")
+
+    async def _pipeline(self, commands: list[tuple]) -> list:
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                self._writer.write(b"".join(self._encode(*cmd) for cmd in commands))
+                await self._writer.drain()
+                replies = [await self._read_reply() for _ in commands]
+            except BaseException:
+                # Replies may be left unread (cancellation, broken connection): never reuse it.
+                self._drop()
+                raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _drop(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self._writer.write(b"".join(self._encode(*cmd) for cmd in setup))
+            await self._writer.drain()
+            for _ in setup:
+                reply = await self._read_reply()
+                if isinstance(reply, RedisError):
+                    raise reply
+
+    async def start(self):
+        async with self._lock:
+            try:
+                await self._connect()
+            except BaseException:
+                self._drop()
+                raise
+
+    async def get(self, ns, key):
+        (value,) = await self._pipeline([("HGET", self.prefix + ns, key)])
+        return value
+
+    async def set_many(self, items):
+        commands = []
+        for ns, key, value in items:
+            if value is None:
+                commands.append(("HDEL", self.prefix + ns, key))
+            else:
+                commands.append(("HSET", self.prefix + ns, key, value))
+        if commands:
+            await self._pipeline(commands)
+
+    async def keys(self, ns):
+        (keys,) = await self._pipeline([("HKEYS", self.prefix + ns)])
+        return keys or []
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+class StateStore:
+    """Read-through LRU cache with write-back of dirty entries on top of a ``StateBackend``.
+
+    Values handed out by ``get`` are the cached objects themselves; after mutating one call
+    ``put`` so it gets written back. Misses are cached too, so unknown users do not hit the
+    backend on every update. ``ttl`` bounds how stale a clean entry may get when several
+    workers share one backend; a namespace written by one worker and read by others
+    (e.g. an admin's shard granting something to a respondent on another shard) should be
+    given its own short ``ttl``. A namespace may register ``decode`` to turn loaded JSON
+    back into objects; such objects are written through their ``dump()`` method.
+    """
+
+    def __init__(self, backend: StateBackend, cache_size: int = 10000,
+                 flush_interval: float = 1.0, ttl: Optional[float] = None):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._cache: OrderedDict[tuple[str, str], tuple[Any, float]] = OrderedDict()
+        self._dirty: set[tuple[str, str]] = set()
+        self._spilled: dict[tuple[str, str], Any] = {}
+        self._decoders: dict[str, Callable[[Any], Any]] = {}
+        self._ttls: dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def namespace(self, ns: str, decode: Optional[Callable[[Any], Any]] = None,
+                  ttl: Optional[float] = None) -> "Namespace":
+        if decode is not None:
+            self._decoders[ns] = decode
+        if ttl is not None:
+            self._ttls[ns] = ttl
+        return Namespace(self, ns)
+
+    async def start(self):
+        await self.backend.start()
+        self._task = asyncio.create_task(self._flush_loop(), name="state-flush")
+
+    def _remember(self, cache_key, value):
+        self._cache[cache_key] = (value, time.monotonic())
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            old_key, (old_value, _) = self._cache.popitem(last=False)
+            if old_key in self._dirty:
+                self._dirty.discard(old_key)
+                self._spilled[old_key] = old_value
+
+    async def get(self, ns: str, key, default=None):
+        cache_key = (ns, str(key))
+        entry = self._cache.get(cache_key)
+        if entry is not None:
+            value, loaded_at = entry
+            ttl = self._ttls.get(ns, self.ttl)
+            if cache_key in self._dirty or ttl is None or time.monotonic() - loaded_at < ttl:
+                self._cache.move_to_end(cache_key)
+                return default if value is _MISSING else value
+        if cache_key in self._spilled:
+            value = self._spilled[cache_key]
+        else:
+            raw = await self.backend.get(*cache_key)
+            # A put (or a fresher load) during the await wins over what was just read.
+            if cache_key in self._spilled:
+                value = self._spilled[cache_key]
+                return default if value is _MISSING else value
+            current = self._cache.get(cache_key)
+            if current is not None and current is not entry:
+                self._cache.move_to_end(cache_key)
+                return default if current[0] is _MISSING else current[0]
+            value = _MISSING if raw is None else json.loads(raw)
+            if value is not _MISSING and ns in self._decoders:
+                value = self._decoders[ns](value)
+        self._remember(cache_key, value)
+        return default if value is _MISSING else value
+
+    def put(self, ns: str, key, value):
+        cache_key = (ns, str(key))
+        self._spilled.pop(cache_key, None)
+        self._remember(cache_key, value)
+        self._dirty.add(cache_key)
+
+    def delete(self, ns: str, key):
+        self.put(ns, key, _MISSING)
+
+    async def keys(self, ns: str) -> list[str]:
+        await self.flush()
+        return await self.backend.keys(ns)
+
+    async def flush(self):
+        if not self._dirty and not self._spilled:
+            return
+        pending = dict(self._spilled)
+        for cache_key in self._dirty:
+            pending[cache_key] = self._cache[cache_key][0]
+        self._dirty.clear()
+        self._spilled.clear()
+        items = [(ns, key, None if value is _MISSING else json.dumps(value, ensure_ascii=False, default=_encode))
+                 for (ns, key), value in pending.items()]
+        try:
+            await self.backend.set_many(items)
+        except Exception:
+            # Keep the entries dirty so the next flush retries them.
+            for cache_key, value in pending.items():
+                if cache_key in self._cache and cache_key not in self._dirty:
+                    self._dirty.add(cache_key)
+                elif cache_key not in self._cache:
+                    self._spilled.setdefault(cache_key, value)
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write back survey state")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await self.backend.close()
+
+
+class Namespace:
+    """Dict/set-like view of one namespace of a ``StateStore``."""
+
+    def __init__(self, store: StateStore, ns: str):
+        self.store = store
+        self.ns = ns
+
+    async def get(self, key, default=None):
+        return await self.store.get(self.ns, key, default)
+
+    def put(self, key, value):
+        self.store.put(self.ns, key, value)
+
+    def delete(self, key):
+        self.store.delete(self.ns, key)
+
+    async def pop(self, key, default=None):
+        value = await self.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.delete(key)
+        return value
+
+    async def contains(self, key) -> bool:
+        return await self.get(key, _MISSING) is not _MISSING
+
+    def add(self, key):
+        self.put(key, True)
+
+    async def keys(self) -> list[str]:
+        return await self.store.keys(self.ns)
+
+
+def backend_from_env(default_sqlite_path: str) -> StateBackend:
+    kind = os.getenv("STATE_BACKEND", "sqlite").lower()
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return SQLiteBackend(os.getenv("STATE_DB_PATH", default_sqlite_path))
+    if kind == "redis":
+        return RedisBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+                            prefix=os.getenv("REDIS_PREFIX", "smokebot:"))
+    raise RuntimeError(f"Unknown STATE_BACKEND: {kind}")
+
+
+def store_from_env(default_sqlite_path: str) -> StateStore:
+    ttl = os.getenv("STATE_CACHE_TTL")
+    return StateStore(
+        backend_from_env(default_sqlite_path),
+        cache_size=int(os.getenv("STATE_CACHE_SIZE", "10000")),
+        flush_interval=float(os.getenv("STATE_FLUSH_INTERVAL", "1.0")),
+        ttl=float(ttl) if ttl else None,
+    )
@@ -0,0 +1,261 @@
+"""Survey statistics kept as incrementally updated aggregates next to a raw event log.
+
+Handlers record events (start, answer, finish, abandon); each event is appended to
+``survey_events`` and applied to the aggregate tables in the same group commit, so
+``snapshot`` reads a handful of small rows instead of scanning ``messages``. ``rebuild``
+recomputes every aggregate from the event log in one streaming pass.
+"""
+import sqlite3
+from collections import Counter, defaultdict
+from typing import Optional
+
+from storage import MessageStore
+
+# Answers longer than this (Telegram's own limit) share the last length bucket.
+MAX_LENGTH = 4096
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS survey_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        survey_id TEXT NOT NULL,
+        event TEXT NOT NULL,
+        q_index INTEGER,
+        length INTEGER,
+        first BOOLEAN,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # Per-respondent scans of one survey, e.g. broadcast recipients who never finished.
+    "CREATE INDEX IF NOT EXISTS idx_survey_events_user ON survey_events (survey_id, user_id, event, timestamp)",
+    """
+    CREATE TABLE IF NOT EXISTS survey_stats (
+        survey_id TEXT PRIMARY KEY,
+        started INTEGER NOT NULL DEFAULT 0,
+        finished INTEGER NOT NULL DEFAULT 0,
+        abandoned INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    # reached: respondents who answered the question at least once; answers: every answer.
+    """
+    CREATE TABLE IF NOT EXISTS question_stats (
+        survey_id TEXT NOT NULL,
+        q_index INTEGER NOT NULL,
+        reached INTEGER NOT NULL DEFAULT 0,
+        answers INTEGER NOT NULL DEFAULT 0,
+        total_length INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (survey_id, q_index)
+    ) WITHOUT ROWID
+    """,
+    # Length histogram with one bucket per length, for exact medians.
+    """
+    CREATE TABLE IF NOT EXISTS answer_lengths (
+        survey_id TEXT NOT NULL,
+        q_index INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (survey_id, q_index, length)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        survey_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        started INTEGER NOT NULL DEFAULT 0,
+        answers INTEGER NOT NULL DEFAULT 0,
+        finished INTEGER NOT NULL DEFAULT 0,
+        abandoned INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (survey_id, day)
+    ) WITHOUT ROWID
+    """,
+]
+
+INSERT_EVENT = "INSERT INTO survey_events (user_id, survey_id, event, q_index, length, first) VALUES (?, ?, ?, ?, ?, ?)"
+
+_BUMP_SURVEY = """
+    INSERT INTO survey_stats (survey_id, {col}) VALUES (?, 1)
+    ON CONFLICT (survey_id) DO UPDATE SET {col} = {col} + 1
+"""
+_BUMP_DAY = """
+    INSERT INTO daily_stats (survey_id, day, {col}) VALUES (?, date('now'), 1)
+    ON CONFLICT (survey_id, day) DO UPDATE SET {col} = {col} + 1
+"""
+_BUMP_QUESTION = """
+    INSERT INTO question_stats (survey_id, q_index, reached, answers, total_length) VALUES (?, ?, ?, 1, ?)
+    ON CONFLICT (survey_id, q_index) DO UPDATE SET
+        reached = reached + excluded.reached,
+        answers = answers + 1,
+        total_length = total_length + excluded.total_length
+"""
+_BUMP_LENGTH = """
+    INSERT INTO answer_lengths (survey_id, q_index, length, count) VALUES (?, ?, ?, 1)
+    ON CONFLICT (survey_id, q_index, length) DO UPDATE SET count = count + 1
+"""
+
+# Seed an empty event log from answers saved before it existed: a start at each
+# respondent's first answer, then the answers (finishes of those respondents are unknown).
+_SEED_STARTS = """
+    INSERT INTO survey_events (user_id, survey_id, event, timestamp)
+    SELECT user_id, coalesce(survey_id, :untagged), 'start', min(timestamp)
+    FROM messages
+    WHERE from_admin = 0 AND q_index IS NOT NULL AND coalesce(survey_id, :untagged) IS NOT NULL
+    GROUP BY user_id, coalesce(survey_id, :untagged)
+    ORDER BY min(id)
+"""
+_SEED_EVENTS = """
+    INSERT INTO survey_events (user_id, survey_id, event, q_index, length, first, timestamp)
+    SELECT user_id, coalesce(survey_id, :untagged), 'answer', q_index, length(text),
+           row_number() OVER (PARTITION BY user_id, coalesce(survey_id, :untagged), q_index ORDER BY id) = 1,
+           timestamp
+    FROM messages
+    WHERE from_admin = 0 AND q_index IS NOT NULL AND coalesce(survey_id, :untagged) IS NOT NULL
+    ORDER BY id
+"""
+
+_AGGREGATE_TABLES = ("survey_stats", "question_stats", "answer_lengths", "daily_stats")
+
+
+def _median(histogram: list[tuple[int, int]]) -> Optional[float]:
+    """Median of a sorted ``(value, count)`` histogram."""
+    total = sum(count for _, count in histogram)
+    if not total:
+        return None
+    lower, upper = (total - 1) // 2, total // 2
+    seen = 0
+    low_value = None
+    for value, count in histogram:
+        if low_value is None and seen + count > lower:
+            low_value = value
+        if seen + count > upper:
+            return (low_value + value) / 2
+        seen += count
+    return None
+
+
+class SurveyStats:
+    def __init__(self, store: MessageStore):
+        self.store = store
+
+    async def start(self, untagged_survey: Optional[str] = None):
+        """Creates the tables; on first use builds the aggregates from existing answers."""
+        def create(conn):
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            return conn.execute("SELECT 1 FROM survey_stats LIMIT 1").fetchone() is None
+
+        if await self.store.run(create):
+            await self.rebuild(untagged_survey)
+
+    def _record(self, user_id: int, survey_id: str, event: str, q_index: Optional[int] = None,
+                length: Optional[int] = None, first: Optional[bool] = None):
+        self.store.enqueue(INSERT_EVENT, (user_id, survey_id, event, q_index, length, first))
+
+    def started(self, user_id: int, survey_id: str):
+        self._record(user_id, survey_id, "start")
+        self.store.enqueue(_BUMP_SURVEY.format(col="started"), (survey_id,))
+        self.store.enqueue(_BUMP_DAY.format(col="started"), (survey_id,))
+
+    def answered(self, user_id: int, survey_id: str, q_index: int, length: int, first: bool):
+        """``first`` is False when the respondent replaces an earlier answer to the question."""
+        length = min(length, MAX_LENGTH)
+        self._record(user_id, survey_id, "answer", q_index, length, first)
+        self.store.enqueue(_BUMP_QUESTION, (survey_id, q_index, int(first), length))
+        self.store.enqueue(_BUMP_LENGTH, (survey_id, q_index, length))
+        self.store.enqueue(_BUMP_DAY.format(col="answers"), (survey_id,))
+
+    def finished(self, user_id: int, survey_id: str):
+        self._record(user_id, survey_id, "finish")
+        self.store.enqueue(_BUMP_SURVEY.format(col="finished"), (survey_id,))
+        self.store.enqueue(_BUMP_DAY.format(col="finished"), (survey_id,))
+
+    def abandoned(self, user_id: int, survey_id: str, q_index: int):
+        self._record(user_id, survey_id, "abandon", q_index)
+        self.store.enqueue(_BUMP_SURVEY.format(col="abandoned"), (survey_id,))
+        self.store.enqueue(_BUMP_DAY.format(col="abandoned"), (survey_id,))
+
+    async def snapshot(self, survey_id: str, days: int = 7) -> dict:
+        totals = await self.store.fetchall(
+            "SELECT started, finished, abandoned FROM survey_stats WHERE survey_id = ?", (survey_id,))
+        questions = await self.store.fetchall(
+            "SELECT q_index, reached, answers, total_length FROM question_stats WHERE survey_id = ? ORDER BY q_index",
+            (survey_id,))
+        lengths = await self.store.fetchall(
+            "SELECT q_index, length, count FROM answer_lengths WHERE survey_id = ? ORDER BY q_index, length",
+            (survey_id,))
+        daily = await self.store.fetchall(
+            "SELECT day, started, answers, finished, abandoned FROM daily_stats "
+            "WHERE survey_id = ? ORDER BY day DESC LIMIT ?", (survey_id, days))
+
+        by_question: dict[int, list] = defaultdict(list)
+        overall: Counter = Counter()
+        for q_index, length, count in lengths:
+            by_question[q_index].append((length, count))
+            overall[length] += count
+        started, finished, abandoned = totals[0] if totals else (0, 0, 0)
+        return {
+            "started": started,
+            "finished": finished,
+            "abandoned": abandoned,
+            "completion_rate": finished / started if started else None,
+            "median_length": _median(sorted(overall.items())),
+            "questions": [
+                {"q_index": q_index, "reached": reached, "answers": answers,
+                 "mean_length": total_length / answers if answers else None,
+                 "median_length": _median(by_question[q_index])}
+                for q_index, reached, answers, total_length in questions
+            ],
+            "daily": [dict(zip(("day", "started", "answers", "finished", "abandoned"), row)) for row in daily],
+        }
+
+    async def rebuild(self, untagged_survey: Optional[str] = None, chunk_size: int = 5000) -> int:
+        """Recomputes all aggregates from ``survey_events``; returns the number of events read."""
+        await self.store.flush()
+        return await self.store.run(self._rebuild, untagged_survey, chunk_size)
+
+    @staticmethod
+    def _rebuild(conn: sqlite3.Connection, untagged_survey: Optional[str], chunk_size: int) -> int:
+        if conn.execute("SELECT 1 FROM survey_events LIMIT 1").fetchone() is None:
+            conn.execute(_SEED_STARTS, {"untagged": untagged_survey})
+            conn.execute(_SEED_EVENTS, {"untagged": untagged_survey})
+
+        surveys: dict[str, Counter] = defaultdict(Counter)
+        questions: dict[tuple, list] = defaultdict(lambda: [0, 0, 0])
+        lengths: Counter = Counter()
+        days: dict[tuple, Counter] = defaultdict(Counter)
+        columns = {"start": "started", "finish": "finished", "abandon": "abandoned", "answer": "answers"}
+        events = 0
+        cursor = conn.execute("SELECT survey_id, event, q_index, length, first, date(timestamp) "
+                              "FROM survey_events ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            events += len(rows)
+            for survey_id, event, q_index, length, first, day in rows:
+                totals = surveys[survey_id]
+                days[(survey_id, day)][columns[event]] += 1
+                if event == "answer":
+                    question = questions[(survey_id, q_index)]
+                    question[0] += bool(first)
+                    question[1] += 1
+                    question[2] += length or 0
+                    lengths[(survey_id, q_index, length or 0)] += 1
+                else:
+                    totals[columns[event]] += 1
+
+        for table in _AGGREGATE_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        conn.executemany("INSERT INTO survey_stats (survey_id, started, finished, abandoned) VALUES (?, ?, ?, ?)",
+                         [(s, c["started"], c["finished"], c["abandoned"]) for s, c in surveys.items()])
+        conn.executemany("INSERT INTO question_stats (survey_id, q_index, reached, answers, total_length) "
+                         "VALUES (?, ?, ?, ?, ?)", [(*key, *value) for key, value in questions.items()])
+        conn.executemany("INSERT INTO answer_lengths (survey_id, q_index, length, count) VALUES (?, ?, ?, ?)",
+                         [(*key, count) for key, count in lengths.items()])
+        conn.executemany("INSERT INTO daily_stats (survey_id, day, started, answers, finished, abandoned) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         [(*key, c["started"], c["answers"], c["finished"], c["abandoned"])
+                          for key, c in days.items()])
+        conn.commit()
+        return events
@@ -0,0 +1,378 @@
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        from_admin BOOLEAN,
+        text TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        q_index INTEGER,
+        survey_id TEXT,
+        superseded BOOLEAN NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id)",
+    # One row per user so admin views never have to scan ``messages``.
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        first_message_id INTEGER,
+        last_message_id INTEGER,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        last_seen DATETIME
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_users_last_message ON users (last_message_id)",
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_users_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO users (user_id, first_message_id, last_message_id, message_count, last_seen)
+        VALUES (new.user_id, new.id, new.id, 1, new.timestamp)
+        ON CONFLICT (user_id) DO UPDATE SET
+            last_message_id = new.id,
+            message_count = message_count + 1,
+            last_seen = new.timestamp;
+    END
+    """,
+    # Partial answers of sessions evicted before the respondent finished.
+    """
+    CREATE TABLE IF NOT EXISTS abandoned_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        survey_id TEXT,
+        survey_version INTEGER,
+        answers TEXT NOT NULL,
+        reason TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_abandoned_sessions_user ON abandoned_sessions (user_id)",
+]
+
+# Full-text index over respondents' messages (admin replies are not indexed). External
+# content: the text lives only in ``messages``; triggers keep the index in step with it.
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages WHEN new.from_admin = 0 BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages WHEN old.from_admin = 0 BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text, from_admin ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) SELECT 'delete', old.id, old.text WHERE old.from_admin = 0;
+        INSERT INTO messages_fts (rowid, text) SELECT new.id, new.text WHERE new.from_admin = 0;
+    END
+    """,
+]
+
+BACKFILL_FTS = "INSERT INTO messages_fts (rowid, text) SELECT id, text FROM messages WHERE from_admin = 0"
+
+# Snippet markers: control characters survive Markdown escaping and are swapped for markup afterwards.
+HIGHLIGHT_START, HIGHLIGHT_END = "\x02", "\x03"
+
+# Columns added after the first release: (table, column, declaration).
+ADDED_COLUMNS = [
+    ("messages", "q_index", "INTEGER"),  # survey question an answer belongs to, NULL otherwise
+    ("messages", "survey_id", "TEXT"),
+    ("messages", "superseded", "BOOLEAN NOT NULL DEFAULT 0"),  # answer dropped by going back or a retake
+]
+
+BACKFILL_USERS = """
+    INSERT OR IGNORE INTO users (user_id, first_message_id, last_message_id, message_count, last_seen)
+    SELECT user_id, MIN(id), MAX(id), COUNT(*), MAX(timestamp) FROM messages GROUP BY user_id
+"""
+
+_SEARCH_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def fts_query(text: str) -> str:
+    """Turns admin input into a safe FTS5 expression: every word or "quoted phrase" must
+    occur, ``word*`` matches a prefix and a bare ``OR`` between two terms is kept."""
+    parts = []
+    for phrase, word in _SEARCH_TERM.findall(text):
+        if word == "OR":
+            if parts and parts[-1] != "OR":
+                parts.append("OR")
+            continue
+        prefix = word.endswith("*")
+        term = phrase or word.rstrip("*")
+        if term.strip():
+            parts.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if parts and parts[-1] == "OR":
+        parts.pop()
+    return " ".join(parts)
+
+
+INSERT_MESSAGE = "INSERT INTO messages (user_id, from_admin, text, q_index, survey_id) VALUES (?, ?, ?, ?, ?)"
+SUPERSEDE_ANSWERS = ("UPDATE messages SET superseded = 1 "
+                     "WHERE user_id = ? AND survey_id = ? AND from_admin = 0 AND q_index IS NOT NULL")
+INSERT_ABANDONED = ("INSERT INTO abandoned_sessions (user_id, survey_id, survey_version, answers, reason) "
+                    "VALUES (?, ?, ?, ?, ?)")
+
+_STOP = object()
+
+DB_WRITES = metrics.counter("bot_db_writes_total", "Statements queued for the SQLite writer.")
+DB_WRITE_FAILURES = metrics.counter("bot_db_write_failures_total", "Group commits that had failing statements.")
+DB_COMMIT_SECONDS = metrics.histogram("bot_db_commit_seconds", "Duration of one group commit.")
+DB_BATCH_SIZE = metrics.histogram("bot_db_commit_batch_size", "Statements per group commit.",
+                                  buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+DB_READ_SECONDS = metrics.histogram("bot_db_read_seconds", "Reads and other work run on the writer thread.")
+
+
+class MessageStore:
+    """Owns one long-lived WAL connection, used only from a dedicated writer thread.
+
+    Handlers enqueue writes with ``enqueue``/``save_message`` without blocking; a background
+    task group-commits them in batches of up to ``batch_size`` statements, waiting at most
+    ``flush_interval`` seconds after the first queued write.
+    """
+
+    def __init__(self, path: str, batch_size: int = 200, flush_interval: float = 0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.fts = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        # Upgrade tables created by older releases before SCHEMA refers to the new columns.
+        for table, column, declaration in ADDED_COLUMNS:
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if existing and column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+            conn.execute(BACKFILL_USERS)
+        self.fts = self._create_fts(conn)
+        conn.commit()
+        self._conn = conn
+
+    @staticmethod
+    def _create_fts(conn: sqlite3.Connection) -> bool:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            for statement in FTS_SCHEMA:
+                conn.execute(statement)
+        except sqlite3.OperationalError:
+            logger.warning("SQLite was built without FTS5, /search is disabled", exc_info=True)
+            return False
+        if not exists:
+            conn.execute(BACKFILL_FTS)
+        return True
+
+    async def start(self):
+        await self.run_sync(self._connect)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._writer(), name="sqlite-writer")
+
+    async def run_sync(self, fn: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Runs ``fn(conn, *args)`` on the writer thread."""
+        with DB_READ_SECONDS.time():
+            return await self.run_sync(lambda: fn(self._conn, *args))
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def enqueue(self, sql: str, params: tuple = ()):
+        self._queue.put_nowait((sql, params))
+        DB_WRITES.inc()
+
+    def save_message(self, user_id: int, text: str, from_admin: bool, q_index: Optional[int] = None,
+                     survey_id: Optional[str] = None):
+        self.enqueue(INSERT_MESSAGE, (user_id, from_admin, text, q_index, survey_id))
+
+    def supersede_answers(self, user_id: int, survey_id: str, q_indices: Optional[Iterable[int]] = None):
+        """Marks stored answers to these questions (all of them if ``q_indices`` is None) as no
+        longer part of the respondent's survey, so exports leave them out."""
+        if q_indices is None:
+            self.enqueue(SUPERSEDE_ANSWERS, (user_id, survey_id))
+            return
+        q_indices = sorted(q_indices)
+        if q_indices:
+            placeholders = ", ".join("?" * len(q_indices))
+            self.enqueue(f"{SUPERSEDE_ANSWERS} AND q_index IN ({placeholders})", (user_id, survey_id, *q_indices))
+
+    def save_abandoned(self, user_id: int, survey_id: str, version: int, answers: list, reason: str):
+        """``answers`` are (question id, answer) pairs, stored as JSON."""
+        self.enqueue(INSERT_ABANDONED, (user_id, survey_id, version, json.dumps(answers, ensure_ascii=False), reason))
+
+    async def flush(self):
+        """Waits until everything enqueued so far has been written (failed writes are logged)."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(waiter)
+        await waiter
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        await self.flush()
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def users_page(self, cursor: Optional[int] = None, backward: bool = False,
+                         limit: int = 10) -> tuple[list, bool]:
+        """Keyset page of users, most recently active first.
+
+        ``cursor`` is a ``last_message_id`` from the previous page; rows are
+        ``(user_id, last_message_id, message_count)``. The flag tells whether more rows exist
+        beyond this page in the direction of travel.
+        """
+        if cursor is None:
+            sql, params = "SELECT user_id, last_message_id, message_count FROM users " \
+                          "ORDER BY last_message_id DESC LIMIT ?", (limit + 1,)
+        elif backward:
+            sql, params = "SELECT user_id, last_message_id, message_count FROM users " \
+                          "WHERE last_message_id > ? ORDER BY last_message_id ASC LIMIT ?", (cursor, limit + 1)
+        else:
+            sql, params = "SELECT user_id, last_message_id, message_count FROM users " \
+                          "WHERE last_message_id < ? ORDER BY last_message_id DESC LIMIT ?", (cursor, limit + 1)
+        rows = await self.fetchall(sql, params)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+
+    async def history_page(self, user_id: int, cursor: Optional[int] = None, backward: bool = False,
+                           limit: int = 20) -> tuple[list, bool]:
+        """Keyset page of one user's messages in chronological order.
+
+        Rows are ``(id, from_admin, text, timestamp)``; the flag means the same as in ``users_page``.
+        """
+        if backward:
+            sql, params = "SELECT id, from_admin, text, timestamp FROM messages " \
+                          "WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?", (user_id, cursor, limit + 1)
+        else:
+            sql, params = "SELECT id, from_admin, text, timestamp FROM messages " \
+                          "WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?", (user_id, cursor or 0, limit + 1)
+        rows = await self.fetchall(sql, params)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+
+    async def search(self, match: str, q_index: Optional[int] = None, date_from: Optional[str] = None,
+                     date_to: Optional[str] = None, offset: int = 0, limit: int = 10) -> tuple[list, bool]:
+        """Respondents' messages matching the FTS5 expression ``match``, best (bm25) first.
+
+        Rows are ``(id, user_id, q_index, timestamp, snippet)`` with hits in the snippet
+        wrapped in ``HIGHLIGHT_START``/``HIGHLIGHT_END``. Dates are ``YYYY-MM-DD``, both
+        ends inclusive. The flag tells whether another page exists.
+        """
+        where, params = ["messages_fts MATCH ?"], [match]
+        if q_index is not None:
+            where.append("m.q_index = ?")
+            params.append(q_index)
+        if date_from:
+            where.append("m.timestamp >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("m.timestamp < date(?, '+1 day')")
+            params.append(date_to)
+        sql = f"""
+            SELECT m.id, m.user_id, m.q_index, m.timestamp, snippet(messages_fts, 0, ?, ?, '…', 16)
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE {" AND ".join(where)}
+            ORDER BY messages_fts.rank, m.id LIMIT ? OFFSET ?
+        """
+        rows = await self.fetchall(sql, (HIGHLIGHT_START, HIGHLIGHT_END, *params, limit + 1, offset))
+        return rows[:limit], len(rows) > limit
+
+    def _commit(self, writes: list):
+        try:
+            for sql, params in writes:
+                self._conn.execute(sql, params)
+            self._conn.commit()
+            return
+        except sqlite3.Error:
+            self._conn.rollback()
+        # One bad statement must not cost the rest of the batch: replay them one by one.
+        failed = 0
+        for sql, params in writes:
+            try:
+                self._conn.execute(sql, params)
+                self._conn.commit()
+            except sqlite3.Error:
+                self._conn.rollback()
+                failed += 1
+                logger.exception("Dropped queued write: %s", sql)
+        if failed:
+            raise sqlite3.DatabaseError(f"{failed} of {len(writes)} queued writes failed")
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size and item is not _STOP and not isinstance(item, asyncio.Future):
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                batch.append(item)
+
+            writes = [i for i in batch if isinstance(i, tuple)]
+            waiters = [i for i in batch if isinstance(i, asyncio.Future)]
+            stopping = any(i is _STOP for i in batch)
+            if writes:
+                DB_BATCH_SIZE.observe(len(writes))
+                try:
+                    with DB_COMMIT_SECONDS.time():
+                        await self.run_sync(self._commit, writes)
+                except Exception:
+                    DB_WRITE_FAILURES.inc()
+                    logger.exception("Failed to commit %d queued writes", len(writes))
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def close(self):
+        """Drains the queue, commits what is left and closes the connection."""
+        if self._task:
+            self._queue.put_nowait(_STOP)
+            await self._task
+            self._task = None
+        if self._conn:
+            await self.run_sync(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
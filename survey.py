@@ -0,0 +1,340 @@
+"""Declarative surveys: definitions are loaded from YAML/JSON files, compiled once into
+immutable indexed structures and hot-reloaded when their file changes.
+
+A definition looks like::
+
+    id: smoking
+    greeting: "..."
+    thank_you: "..."
+    labels: {back: "⬅️ Назад", next: "➡️ Далее", finish: "✅ Завершить"}   # optional
+    questions:
+      - id: first_time
+        text: "1️⃣ ..."
+        validate: {min_length: 2, max_length: 3000, pattern: "...", error: "..."}  # optional
+        next:                                   # optional branching, first match wins
+          - {match: "(?i)^нет", goto: therapy}  # regex on the answer -> question id
+          - {goto: finish}                      # no match -> unconditional; "finish" ends
+
+Without ``next`` a question is followed by the next one in the list. Sessions record the
+survey id and version they were started on, so a reload never changes the questions under
+a respondent who is halfway through. The version is derived from the definition itself,
+so it means the same questions after a restart and on every replica.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
+
+from sessions import Session
+
+logger = logging.getLogger(__name__)
+
+FINISH = -1
+DEFAULT_ERROR = "Ответ не подходит, попробуйте ещё раз."
+
+
+class SurveyError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class NavLabels:
+    back: str = "⬅️ Назад"
+    next: str = "➡️ Далее"
+    finish: str = "✅ Завершить"
+
+
+@dataclass(frozen=True)
+class CompiledQuestion:
+    id: str
+    index: int
+    text: str
+    text_md: str
+    min_length: int
+    max_length: Optional[int]
+    pattern: Optional[re.Pattern]
+    error: str
+    branches: tuple[tuple[Optional[re.Pattern], int], ...]
+    default_next: int
+
+    def validate(self, answer: str) -> Optional[str]:
+        """Error message for an unacceptable answer, ``None`` if it is fine."""
+        answer = answer or ""
+        if len(answer.strip()) < self.min_length:
+            return self.error
+        if self.max_length is not None and len(answer) > self.max_length:
+            return self.error
+        if self.pattern is not None and not self.pattern.search(answer):
+            return self.error
+        return None
+
+    def next_index(self, answer: str) -> int:
+        for pattern, target in self.branches:
+            if pattern is None or pattern.search(answer or ""):
+                return target
+        return self.default_next
+
+
+@dataclass(frozen=True)
+class CompiledSurvey:
+    """Survey prepared once: MarkdownV2-escaped question texts and shared, immutable
+    keyboards, so handlers only have to escape user input."""
+
+    id: str
+    version: int
+    greeting: str
+    thank_you: str
+    questions: tuple[CompiledQuestion, ...]
+    index_by_id: Mapping[str, int]
+    start_markup: InlineKeyboardMarkup
+    # Navigation keyboards by (has_back, is_last): first, middle, last and only question.
+    nav_markups: Mapping[tuple[bool, bool], InlineKeyboardMarkup]
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def nav_markup(self, q_index: int, answer: str = "") -> InlineKeyboardMarkup:
+        question = self.questions[q_index]
+        return self.nav_markups[(q_index > 0, question.next_index(answer) == FINISH)]
+
+    # Session helpers; see ``sessions.Session``.
+
+    def adopt(self, session: Session):
+        """Moves a session from a version that is no longer retained onto this one."""
+        if session.survey == self.id and session.version == self.version:
+            return
+        session.path = [i for i in session.path if i < len(self.questions)] or [0]
+        session.survey, session.version = self.id, self.version
+        del session.answers[len(session.path):]
+        session.ahead = []
+
+    def new_session(self) -> Session:
+        return Session(self.id, self.version)
+
+    def current(self, session: Session) -> CompiledQuestion:
+        return self.questions[session.path[-1]]
+
+    def current_answer(self, session: Session) -> Optional[str]:
+        position = len(session.path) - 1
+        return session.answers[position] if position < len(session.answers) else None
+
+    def record_answer(self, session: Session, answer: str) -> Optional[str]:
+        """Stores the answer for the current question; returns a validation error instead."""
+        error = self.current(session).validate(answer)
+        if error:
+            return error
+        position = len(session.path) - 1
+        if len(session.answers) > position:
+            session.answers[position] = answer
+        else:
+            session.answers.append(answer)
+        return None
+
+    def advance(self, session: Session) -> bool:
+        """Moves to the next question if the current one is answered and is not the last."""
+        answer = self.current_answer(session)
+        if answer is None:
+            return False
+        target = self.current(session).next_index(answer)
+        if target == FINISH:
+            return False
+        if session.ahead and session.ahead[-1] == target:
+            session.ahead.pop()  # same branch as before going back: its answers still apply
+        else:
+            session.ahead = []
+            del session.answers[len(session.path):]
+        session.path.append(target)
+        return True
+
+    def answered_indices(self, session: Session) -> list[int]:
+        """Questions the session holds answers for, including those kept ahead after going back."""
+        return (session.path + session.ahead[::-1])[:len(session.answers)]
+
+    def back(self, session: Session) -> bool:
+        if len(session.path) < 2:
+            return False
+        session.ahead.append(session.path.pop())
+        return True
+
+    def finished_answers(self, session: Session) -> list[tuple[str, str]]:
+        """(question, answer) pairs along the path actually taken."""
+        return [(self.questions[i].text, answer) for i, answer in zip(session.path, session.answers)]
+
+
+def _load_file(path: str) -> dict:
+    with open(path, encoding="utf-8") as fp:
+        if path.endswith(".json"):
+            return json.load(fp)
+        import yaml
+        return yaml.safe_load(fp)
+
+
+def definition_version(definition: dict) -> int:
+    """Version number of a definition: 32 bits of a hash of its canonical JSON form."""
+    canonical = json.dumps(definition, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return int.from_bytes(hashlib.sha256(canonical.encode()).digest()[:4], "big")
+
+
+def compile_survey(definition: dict, version: Optional[int] = None,
+                   labels: Optional[NavLabels] = None) -> CompiledSurvey:
+    if version is None:
+        version = definition_version(definition)
+    survey_id = definition.get("id")
+    if not survey_id or not re.fullmatch(r"[A-Za-z0-9_-]{1,32}", survey_id):
+        raise SurveyError(f"Survey id must be 1-32 of [A-Za-z0-9_-], got {survey_id!r}")
+    items = definition.get("questions") or []
+    if not items:
+        raise SurveyError(f"Survey {survey_id} has no questions")
+    if labels is None:
+        labels = NavLabels(**definition.get("labels", {}))
+
+    ids = []
+    for i, item in enumerate(items):
+        if isinstance(item, str):
+            item = items[i] = {"text": item}
+        ids.append(str(item.get("id", i + 1)))
+    index_by_id = {qid: i for i, qid in enumerate(ids)}
+    if len(index_by_id) != len(ids):
+        raise SurveyError(f"Survey {survey_id} has duplicate question ids")
+
+    def target(name) -> int:
+        if name == "finish":
+            return FINISH
+        if str(name) not in index_by_id:
+            raise SurveyError(f"Survey {survey_id}: unknown goto target {name!r}")
+        return index_by_id[str(name)]
+
+    questions = []
+    for i, item in enumerate(items):
+        rules = item.get("validate", {})
+        branches = tuple(
+            (re.compile(rule["match"]) if rule.get("match") else None, target(rule["goto"]))
+            for rule in item.get("next", [])
+        )
+        questions.append(CompiledQuestion(
+            id=ids[i],
+            index=i,
+            text=item["text"],
+            text_md=escape_markdown(item["text"], version=2),
+            min_length=int(rules.get("min_length", 1)),
+            max_length=rules.get("max_length"),
+            pattern=re.compile(rules["pattern"]) if rules.get("pattern") else None,
+            error=rules.get("error", DEFAULT_ERROR),
+            branches=branches,
+            default_next=i + 1 if i + 1 < len(items) else FINISH,
+        ))
+
+    back = InlineKeyboardButton(labels.back, callback_data="back_question")
+    next_ = InlineKeyboardButton(labels.next, callback_data="next_question")
+    finish = InlineKeyboardButton(labels.finish, callback_data="finish_survey")
+    # Telegram objects are frozen after construction, so these are shared by every handler call.
+    nav_markups = {
+        (False, False): InlineKeyboardMarkup([[next_]]),
+        (True, False): InlineKeyboardMarkup([[back, next_]]),
+        (True, True): InlineKeyboardMarkup([[back, finish]]),
+        (False, True): InlineKeyboardMarkup([[finish]]),
+    }
+    start_button = InlineKeyboardButton(definition.get("start_button", "Начать опрос"),
+                                        callback_data=f"start_survey:{survey_id}")
+    return CompiledSurvey(
+        id=survey_id,
+        version=version,
+        greeting=definition.get("greeting", ""),
+        thank_you=definition.get("thank_you", ""),
+        questions=tuple(questions),
+        index_by_id=MappingProxyType(index_by_id),
+        start_markup=InlineKeyboardMarkup([[start_button]]),
+        nav_markups=MappingProxyType(nav_markups),
+    )
+
+
+class SurveyRegistry:
+    """All surveys found in ``directory`` (``*.yaml``, ``*.yml``, ``*.json``).
+
+    ``reload`` recompiles files whose mtime changed; a file that fails to compile keeps
+    its previous version. The last ``keep_versions`` versions of each survey stay
+    available to ``get`` so in-flight sessions can finish on the version they started.
+    """
+
+    def __init__(self, directory: str, default_id: str, labels: Optional[NavLabels] = None,
+                 keep_versions: int = 8):
+        self.directory = directory
+        self.default_id = default_id
+        self.labels = labels
+        self.keep_versions = keep_versions
+        self._mtimes: dict[str, float] = {}
+        self._current: dict[str, CompiledSurvey] = {}
+        self._versions: dict[str, dict[int, CompiledSurvey]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def reload(self) -> list[str]:
+        """Recompiles changed files; returns the ids of surveys that changed."""
+        changed = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith((".yaml", ".yml", ".json")):
+                continue
+            path = os.path.join(self.directory, name)
+            mtime = os.stat(path).st_mtime
+            if self._mtimes.get(path) == mtime:
+                continue
+            self._mtimes[path] = mtime
+            try:
+                survey = compile_survey(_load_file(path), labels=self.labels)
+            except Exception:
+                logger.exception("Failed to load survey from %s", path)
+                continue
+            versions = self._versions.setdefault(survey.id, {})
+            versions.pop(survey.version, None)  # re-inserted as the newest
+            versions[survey.version] = survey
+            for old in list(versions)[:-self.keep_versions]:
+                del versions[old]
+            self._current[survey.id] = survey
+            changed.append(survey.id)
+            logger.info("Loaded survey %s v%08x from %s", survey.id, survey.version, name)
+        if self.default_id not in self._current:
+            raise SurveyError(f"Default survey {self.default_id!r} not found in {self.directory}")
+        return changed
+
+    def get(self, survey_id: Optional[str] = None, version: Optional[int] = None) -> Optional[CompiledSurvey]:
+        survey_id = survey_id or self.default_id
+        if version is not None:
+            survey = self._versions.get(survey_id, {}).get(version)
+            if survey is not None:
+                return survey
+        return self._current.get(survey_id)
+
+    def for_session(self, session: Session) -> CompiledSurvey:
+        survey = self.get(session.survey, session.version) or self.get()
+        survey.adopt(session)
+        return survey
+
+    def ids(self) -> list[str]:
+        return sorted(self._current)
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Survey reload failed")
+
+    def start_watching(self, interval: float = 5.0):
+        self._task = asyncio.create_task(self._watch(interval), name="survey-reload")
+
+    async def stop_watching(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
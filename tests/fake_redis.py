@@ -0,0 +1,76 @@
+"""In-process stand-in for a Redis server: the RESP2 subset ``RedisBackend`` uses."""
+import asyncio
+from typing import Optional
+
+
+class FakeRedis:
+    def __init__(self, password: Optional[str] = None):
+        self.password = password
+        self.hashes: dict[str, dict[str, str]] = {}
+        self.fail_on: set[str] = set()  # fields whose HSET answers with an error
+        self.stall = asyncio.Event()  # set: stop answering (to test cancellation)
+        self.connections = 0
+        self._clients: set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for writer in self._clients:
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    @staticmethod
+    def _bulk(value: Optional[str]) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        data = value.encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    def _execute(self, args: list[str]) -> bytes:
+        command, *rest = args
+        command = command.upper()
+        if command == "AUTH":
+            return b"+OK\r\n" if rest[0] == self.password else b"-WRONGPASS invalid password\r\n"
+        if command == "SELECT":
+            return b"+OK\r\n"
+        if command == "HGET":
+            return self._bulk(self.hashes.get(rest[0], {}).get(rest[1]))
+        if command == "HSET":
+            if rest[1] in self.fail_on:
+                return b"-OOM command not allowed\r\n"
+            fields = self.hashes.setdefault(rest[0], {})
+            new = rest[1] not in fields
+            fields[rest[1]] = rest[2]
+            return b":%d\r\n" % new
+        if command == "HDEL":
+            return b":%d\r\n" % (self.hashes.get(rest[0], {}).pop(rest[1], None) is not None)
+        if command == "HKEYS":
+            keys = list(self.hashes.get(rest[0], {}))
+            return b"*%d\r\n" % len(keys) + b"".join(self._bulk(k) for k in keys)
+        return b"-ERR unknown command\r\n"
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._clients.add(writer)
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                args = []
+                for _ in range(int(header[1:-2])):
+                    size = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(size + 2))[:-2].decode())
+                if self.stall.is_set():
+                    continue
+                writer.write(self._execute(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
@@ -0,0 +1,133 @@
+import asyncio
+
+from telegram.error import Forbidden
+
+from broadcast import Broadcasts
+from storage import MessageStore
+
+
+class FakeOutbox:
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+
+    def send_message(self, chat_id, text, priority=0, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        if chat_id in self.blocked:
+            future.set_exception(Forbidden("bot was blocked by the user"))
+        else:
+            self.sent.append((chat_id, text))
+            future.set_result(None)
+        return future
+
+
+async def _store(path, users=range(1, 11)):
+    store = MessageStore(str(path))
+    await store.start()
+    for user_id in users:
+        store.save_message(user_id, "hi", from_admin=False)
+    await store.flush()
+    return store
+
+
+async def _wait(broadcasts):
+    while broadcasts.running:
+        await asyncio.sleep(0.01)
+    await broadcasts.store.flush()
+
+
+def test_all_without_exclusions_selects_everyone(tmp_path):
+    async def main():
+        store = await _store(tmp_path / "db")
+        broadcasts = Broadcasts(store, FakeOutbox())
+        await broadcasts.start()
+        assert (await broadcasts.create(1, "all", "news"))[1] == 10
+        excluding = Broadcasts(store, FakeOutbox(), exclude=[1, 2])
+        assert (await excluding.create(1, "all", "news"))[1] == 8
+        await store.close()
+
+    asyncio.run(main())
+
+
+def test_answered_is_scoped_to_the_survey(tmp_path):
+    async def main():
+        store = await _store(tmp_path / "db", users=())
+        store.save_message(1, "yes", from_admin=False, q_index=0)  # before survey_id was recorded
+        store.save_message(2, "yes", from_admin=False, q_index=0, survey_id="main")
+        store.save_message(3, "yes", from_admin=False, q_index=0, survey_id="other")
+        await store.flush()
+        broadcasts = Broadcasts(store, FakeOutbox(), default_survey="main")
+        await broadcasts.start()
+        assert (await broadcasts.create(1, "answered:1", "news"))[1] == 2
+        assert (await broadcasts.create(1, "answered:1@other", "news"))[1] == 1
+        assert (await broadcasts.create(1, "answered:1:yes@other", "news"))[1] == 1
+        await store.close()
+
+    asyncio.run(main())
+
+def test_blocked_users_are_recorded_and_skipped(tmp_path):
+    async def main():
+        store = await _store(tmp_path / "db")
+        outbox = FakeOutbox(blocked={3, 4})
+        broadcasts = Broadcasts(store, outbox, chunk_size=3)
+        await broadcasts.start()
+        broadcast_id, total = await broadcasts.create(99, "all", "news")
+        assert await broadcasts.launch(broadcast_id)
+        await _wait(broadcasts)
+        result = await broadcasts.get(broadcast_id)
+        assert (result["status"], result["sent"], result["blocked"]) == ("done", 8, 2)
+        assert (await broadcasts.create(99, "all", "again"))[1] == 8
+        broadcasts.unblock(3)
+        assert (await broadcasts.create(99, "all", "again"))[1] == 9
+        await store.close()
+
+    asyncio.run(main())
+
+
+def test_running_broadcast_is_resumed_by_one_process_only(tmp_path):
+    async def main():
+        store = await _store(tmp_path / "db")
+        first = Broadcasts(store, FakeOutbox())
+        await first.start()
+        broadcast_id, _ = await first.create(99, "all", "news")
+        await store.run(lambda conn: (conn.execute("UPDATE broadcasts SET status = 'running' WHERE id = ?",
+                                                   (broadcast_id,)), conn.commit()))
+        # Two replicas restart at once on the same database file.
+        other_store = MessageStore(str(tmp_path / "db"))
+        await other_store.start()
+        outboxes = [FakeOutbox(), FakeOutbox()]
+        replicas = [Broadcasts(store, outboxes[0]), Broadcasts(other_store, outboxes[1])]
+        for replica in replicas:
+            await replica.start()
+        assert sorted(replica.running for replica in replicas) == [0, 1]
+        for replica in replicas:
+            await _wait(replica)
+        delivered = [chat_id for outbox in outboxes for chat_id, text in outbox.sent if text == "news"]
+        assert sorted(delivered) == list(range(1, 11))
+        await other_store.close()
+        await store.close()
+
+    asyncio.run(main())
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    async def main():
+        store = await _store(tmp_path / "db")
+        crashed = Broadcasts(store, FakeOutbox())
+        await crashed.start()
+        broadcast_id, _ = await crashed.create(99, "all", "news")
+        await store.run(lambda conn: (conn.execute(
+            "UPDATE broadcasts SET status = 'running', owner = 'gone', lease_until = datetime('now', '+60 seconds') "
+            "WHERE id = ?", (broadcast_id,)), conn.commit()))
+        survivor = Broadcasts(store, FakeOutbox())
+        await survivor.start()
+        assert survivor.running == 0
+        await store.run(lambda conn: (conn.execute(
+            "UPDATE broadcasts SET lease_until = datetime('now', '-1 seconds') WHERE id = ?", (broadcast_id,)),
+            conn.commit()))
+        assert await survivor.resume() == 1
+        await _wait(survivor)
+        assert (await survivor.get(broadcast_id))["status"] == "done"
+        await store.close()
+
+    asyncio.run(main())
@@ -0,0 +1,27 @@
+from digest import _safe_cut, split_markdown
+
+
+def test_safe_cut_does_not_separate_an_escape():
+    assert _safe_cut("ab\\.cd", 3) == 2  # "ab" | "\\.cd"
+    assert _safe_cut("a\\\\\\.b", 4) == 3  # odd run: the last backslash escapes "."
+    assert _safe_cut("a\\\\b", 3) == 3  # even run: "\\\\" is a complete escaped backslash
+    assert _safe_cut("abcd", 2) == 2
+
+
+def test_long_block_is_cut_and_continuations_repeat_the_header():
+    header = "*H*\n"
+    block = "x\\." * 20  # 60 characters of escaped dots
+    messages = split_markdown(header, ["short", block, "tail"], limit=24)
+    assert messages[0] == header + "short"
+    assert all(m.startswith(header) and len(m) <= 24 for m in messages)
+    body = "".join(m[len(header):] for m in messages[1:])
+    assert body.replace("\n\n", "") == block + "tail"
+    for m in messages:
+        text = m[len(header):]
+        trailing = len(text) - len(text.rstrip("\\"))
+        assert trailing % 2 == 0  # no message ends in a dangling escape
+
+
+def test_blocks_that_fit_share_a_message():
+    assert split_markdown("H\n", ["a", "b"], limit=100) == ["H\na\n\nb"]
+    assert split_markdown("H\n", [], limit=100) == ["H\n"]
@@ -0,0 +1,79 @@
+import asyncio
+
+from telegram import Chat, Message, Update, User
+
+from dispatcher import PerUserUpdateProcessor
+
+
+def _update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, f"user{user_id}", is_bot=False)
+    message = Message(update_id, None, Chat(user_id, "private"), from_user=user, text="x")
+    return Update(update_id, message=message)
+
+
+def test_one_users_backlog_does_not_block_others():
+    async def main():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4, max_user_backlog=20)
+        release = asyncio.Event()
+        done = []
+
+        async def slow(n):
+            await release.wait()
+            done.append(("slow", n))
+
+        async def fast():
+            done.append("fast")
+
+        tasks = [asyncio.create_task(processor.process_update(_update(n, 1), slow(n))) for n in range(6)]
+        await asyncio.sleep(0)
+        other = asyncio.create_task(processor.process_update(_update(100, 2), fast()))
+        await asyncio.wait_for(other, 1)
+        assert done == ["fast"]
+        assert processor.backlog(1) == 6
+        release.set()
+        await asyncio.gather(*tasks)
+        assert done[1:] == [("slow", n) for n in range(6)]
+
+    asyncio.run(main())
+
+
+def test_cap_applies_across_users():
+    async def main():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        release = asyncio.Event()
+        peak = 0
+
+        async def handler():
+            nonlocal peak
+            peak = max(peak, processor.current_concurrent_updates)
+            await release.wait()
+
+        tasks = [asyncio.create_task(processor.process_update(_update(n, n), handler())) for n in range(5)]
+        await asyncio.sleep(0.05)
+        assert processor.current_concurrent_updates == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        assert peak == 2
+        assert processor.current_concurrent_updates == 0
+
+    asyncio.run(main())
+
+
+def test_backlog_over_limit_is_dropped():
+    async def main():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4, max_user_backlog=2)
+        release = asyncio.Event()
+        ran = []
+
+        async def handler(n):
+            await release.wait()
+            ran.append(n)
+
+        tasks = [asyncio.create_task(processor.process_update(_update(n, 1), handler(n))) for n in range(4)]
+        await asyncio.sleep(0.05)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert ran == [0, 1]
+        assert processor.dropped == 2
+
+    asyncio.run(main())
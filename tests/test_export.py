@@ -0,0 +1,33 @@
+import asyncio
+
+from export import connect_readonly, iter_respondents
+from storage import MessageStore
+
+
+def test_answers_left_behind_are_not_exported(tmp_path):
+    path = str(tmp_path / "db")
+
+    async def main():
+        store = MessageStore(path)
+        await store.start()
+        # User 1 answers A and B, goes back and takes the branch to C instead.
+        store.save_message(1, "no", from_admin=False, q_index=0, survey_id="s")
+        store.save_message(1, "b-answer", from_admin=False, q_index=1, survey_id="s")
+        store.save_message(1, "yes", from_admin=False, q_index=0, survey_id="s")
+        store.supersede_answers(1, "s", {1})
+        store.save_message(1, "c-answer", from_admin=False, q_index=2, survey_id="s")
+        # User 2 finishes once, then retakes and answers only A.
+        store.save_message(2, "first", from_admin=False, q_index=0, survey_id="s")
+        store.save_message(2, "b-first", from_admin=False, q_index=1, survey_id="s")
+        store.supersede_answers(2, "s")
+        store.save_message(2, "second", from_admin=False, q_index=0, survey_id="s")
+        await store.close()
+
+    asyncio.run(main())
+    conn = connect_readonly(path)
+    rows = list(iter_respondents(conn, 3, chunk_size=2, survey_id="s"))
+    conn.close()
+    assert [(r["user_id"], r["q1"], r["q2"], r["q3"]) for r in rows] == [
+        (1, "yes", None, "c-answer"),
+        (2, "second", None, None),
+    ]
@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut
+
+from outbox import PRIORITY_ADMIN, PRIORITY_BULK, PRIORITY_USER, Outbox
+
+
+def _outbox(**kwargs) -> Outbox:
+    kwargs.setdefault("report_interval", 0)
+    kwargs.setdefault("backoff", 0.01)
+    return Outbox(**kwargs)
+
+
+@pytest.mark.parametrize("error", [BadRequest("Can't parse entities"), Forbidden("bot was blocked")])
+def test_rejected_requests_are_not_retried(error):
+    async def main():
+        outbox = _outbox(chat_rate=100, chat_burst=100, backoff=1.0)
+        await outbox.start(bot=None)
+        calls = []
+
+        async def call():
+            calls.append(time.monotonic())
+            raise error
+
+        started = time.monotonic()
+        failed = outbox.submit(1, call)
+        with pytest.raises(type(error)):
+            await failed
+        assert len(calls) == 1
+        assert time.monotonic() - started < 0.5
+        # The chat is free again for the next message.
+        assert await outbox.submit(1, lambda: asyncio.sleep(0, "ok")) == "ok"
+        await outbox.close()
+
+    asyncio.run(main())
+
+
+def test_timeouts_are_retried():
+    async def main():
+        outbox = _outbox(max_attempts=3)
+        await outbox.start(bot=None)
+        attempts = []
+
+        async def call():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise TimedOut()
+            return "sent"
+
+        assert await outbox.submit(1, call) == "sent"
+        assert outbox.retries == 2
+        await outbox.close()
+
+    asyncio.run(main())
+
+
+def test_user_messages_go_before_admin_and_bulk():
+    async def main():
+        outbox = _outbox(workers=1, chat_rate=100, chat_burst=100)
+        await outbox.start(bot=None)
+        release = asyncio.Event()
+        order = []
+
+        def job(name):
+            async def call():
+                order.append(name)
+            return call
+
+        busy = outbox.submit(0, release.wait)
+        await asyncio.sleep(0.01)  # the only worker is now busy
+        futures = [
+            outbox.submit(1, job("bulk"), PRIORITY_BULK),
+            outbox.submit(2, job("admin"), PRIORITY_ADMIN),
+            outbox.submit(3, job("user"), PRIORITY_USER),
+            outbox.submit(4, job("admin-2"), PRIORITY_ADMIN),
+        ]
+        release.set()
+        await asyncio.gather(busy, *futures)
+        assert order == ["user", "admin", "admin-2", "bulk"]
+        await outbox.close()
+
+    asyncio.run(main())
+
+
+def test_messages_to_one_chat_keep_their_order():
+    async def main():
+        outbox = _outbox(workers=4, chat_rate=100, chat_burst=100)
+        await outbox.start(bot=None)
+        order = []
+
+        def job(n):
+            async def call():
+                await asyncio.sleep(0.001 * (5 - n))
+                order.append(n)
+            return call
+
+        await asyncio.gather(*(outbox.submit(1, job(n)) for n in range(5)))
+        assert order == list(range(5))
+        await outbox.close()
+
+    asyncio.run(main())
+
+
+def test_retry_after_pauses_every_worker():
+    async def main():
+        outbox = _outbox(workers=2, chat_rate=100, chat_burst=100)
+        await outbox.start(bot=None)
+        sent = {}
+        attempts = []
+
+        async def flooded():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(0.3)
+            sent["flooded"] = time.monotonic()
+
+        async def other():
+            sent["other"] = time.monotonic()
+
+        started = time.monotonic()
+        first = outbox.submit(1, flooded)
+        await asyncio.sleep(0.05)
+        await asyncio.gather(first, outbox.submit(2, other))
+        assert outbox.flood_waits == 1
+        assert len(attempts) == 2
+        assert sent["flooded"] - started >= 0.3
+        assert sent["other"] - started >= 0.3  # another chat waited for the pause too
+        await outbox.close()
+
+    asyncio.run(main())
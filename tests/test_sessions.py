@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from sessions import Session, SessionManager
+from state_store import MemoryBackend, StateStore
+
+
+def _manager(**kwargs):
+    store = StateStore(MemoryBackend(), flush_interval=3600)
+    namespace = store.namespace("sessions", decode=Session.load)
+    calls = {"remind": [], "expire": []}
+
+    async def on_remind(user_id, session):
+        calls["remind"].append(user_id)
+
+    async def on_expire(user_id, session, reason):
+        calls["expire"].append((user_id, reason))
+
+    manager = SessionManager(namespace, on_remind=on_remind, on_expire=on_expire, **kwargs)
+    return manager, namespace, calls
+
+
+def test_sweep_reminds_once_then_expires():
+    async def main():
+        manager, namespace, calls = _manager(ttl=100, remind_after=10)
+        manager.put(1, Session("s", 1))
+        manager.put(2, Session("s", 1))
+        now = time.time()
+        assert await manager.sweep(now=now + 1) == (0, 0)
+        assert await manager.sweep(now=now + 20) == (2, 0)
+        assert await manager.sweep(now=now + 30) == (0, 0)  # already reminded
+        assert (await namespace.get(1)).reminded
+        manager.put(2, await namespace.get(2))  # activity: 2 can be reminded again
+        assert await manager.sweep(now=now + 30) == (1, 0)
+        assert await manager.sweep(now=now + 101) == (0, 2)
+        assert calls == {"remind": [1, 2, 2], "expire": [(1, "idle"), (2, "idle")]}
+        assert await namespace.get(1) is None
+        assert len(manager) == 0
+
+    asyncio.run(main())
+
+
+def test_cap_expires_the_oldest_session():
+    async def main():
+        manager, namespace, calls = _manager(max_sessions=2)
+        for user_id in (1, 2, 3):
+            manager.put(user_id, Session("s", 1))
+        await manager.close()
+        assert calls["expire"] == [(1, "cap")]
+        assert await namespace.get(1) is None
+        assert len(manager) == 2
+
+    asyncio.run(main())
+
+
+def test_session_resumed_while_expiring_is_kept():
+    async def main():
+        manager, namespace, calls = _manager(ttl=10)
+        manager.put(1, Session("s", 1))
+        load = namespace.get
+
+        async def slow_get(key, default=None):
+            await asyncio.sleep(0.01)
+            return await load(key, default)
+
+        namespace.get = slow_get
+        sweep = asyncio.create_task(manager.sweep(now=time.time() + 20))
+        await asyncio.sleep(0)  # the sweep is now waiting for the session to load
+        manager.put(1, Session("s", 1, path=[0, 1]))
+        assert await sweep == (0, 1)
+        assert calls["expire"] == []
+        assert (await load(1)).path == [0, 1]
+        assert len(manager) == 1
+
+    asyncio.run(main())
+
+
+def test_start_indexes_only_owned_sessions():
+    async def main():
+        manager, namespace, _ = _manager(ttl=10)
+        for user_id in range(4):
+            namespace.put(user_id, Session("s", 1, updated_at=100.0 + user_id))
+        owned = SessionManager(namespace, ttl=10, owns=lambda user_id: user_id % 2 == 0)
+        await owned.start()
+        assert list(owned._index) == ["0", "2"]
+
+    asyncio.run(main())
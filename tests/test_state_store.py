@@ -0,0 +1,193 @@
+import asyncio
+import json
+
+import pytest
+
+from fake_redis import FakeRedis
+from state_store import MemoryBackend, RedisBackend, RedisError, SQLiteBackend, StateBackend, StateStore
+
+
+async def _redis(**kwargs):
+    server = FakeRedis(**kwargs)
+    port = await server.start()
+    return server, port
+
+
+def test_redis_roundtrip():
+    async def main():
+        server, port = await _redis(password="secret")
+        backend = RedisBackend(f"redis://:secret@127.0.0.1:{port}/2", prefix="t:")
+        await backend.start()
+        await backend.set_many([("ns", "1", '{"a": 1}'), ("ns", "2", "true"), ("other", "1", "1")])
+        assert await backend.get("ns", "1") == '{"a": 1}'
+        assert await backend.get("ns", "missing") is None
+        assert sorted(await backend.keys("ns")) == ["1", "2"]
+        await backend.set_many([("ns", "1", None)])
+        assert await backend.keys("ns") == ["2"]
+        await backend.close()
+        await server.close()
+
+    asyncio.run(main())
+
+
+def test_redis_error_reply_does_not_desync_pipeline():
+    async def main():
+        server, port = await _redis()
+        backend = RedisBackend(f"redis://127.0.0.1:{port}/0")
+        await backend.start()
+        server.fail_on.add("bad")
+        with pytest.raises(RedisError):
+            await backend.set_many([("ns", "a", "1"), ("ns", "bad", "2"), ("ns", "c", "3")])
+        # Every reply of the failed pipeline was consumed: the next command reads its own.
+        assert await backend.get("ns", "missing") is None
+        assert await backend.get("ns", "c") == "3"
+        await backend.close()
+        await server.close()
+
+    asyncio.run(main())
+
+
+def test_redis_reconnects_after_cancellation():
+    async def main():
+        server, port = await _redis()
+        backend = RedisBackend(f"redis://127.0.0.1:{port}/0")
+        await backend.start()
+        await backend.set_many([("ns", "a", "1")])
+        server.stall.set()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(backend.get("ns", "a"), 0.1)
+        server.stall.clear()
+        assert await backend.get("ns", "a") == "1"
+        assert server.connections == 2
+        await backend.close()
+        await server.close()
+
+    asyncio.run(main())
+
+
+def test_redis_reconnects_after_server_restart():
+    async def main():
+        server, port = await _redis()
+        backend = RedisBackend(f"redis://127.0.0.1:{port}/0")
+        await backend.start()
+        await server.close()
+        with pytest.raises((ConnectionError, OSError)):
+            await backend.get("ns", "a")
+        restarted = FakeRedis()
+        await restarted.start(port)
+        await backend.set_many([("ns", "a", "1")])
+        assert restarted.hashes == {"smokebot:ns": {"a": "1"}}
+        await backend.close()
+        await restarted.close()
+
+    asyncio.run(main())
+
+
+class _CountingBackend(MemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+        self.fail = False
+
+    async def get(self, ns, key):
+        self.reads += 1
+        return await super().get(ns, key)
+
+    async def set_many(self, items):
+        if self.fail:
+            raise ConnectionError("backend down")
+        await super().set_many(items)
+
+
+def test_evicted_dirty_entries_are_kept_until_written_back():
+    async def main():
+        backend = _CountingBackend()
+        store = StateStore(backend, cache_size=2, flush_interval=3600)
+        users = store.namespace("users")
+        for i in range(5):
+            users.put(i, {"n": i})
+        # Evicted before any flush: still served from memory, not lost.
+        assert await users.get(0) == {"n": 0}
+        assert backend.reads == 0
+        await store.flush()
+        assert sorted(await backend.keys("users")) == ["0", "1", "2", "3", "4"]
+        assert json.loads(await backend.get("users", "1")) == {"n": 1}
+
+    asyncio.run(main())
+
+
+def test_failed_write_back_is_retried():
+    async def main():
+        backend = _CountingBackend()
+        store = StateStore(backend, cache_size=1, flush_interval=3600)
+        users = store.namespace("users")
+        users.put(1, "a")
+        users.put(2, "b")  # evicts 1 while dirty
+        users.delete(3)
+        backend.fail = True
+        with pytest.raises(ConnectionError):
+            await store.flush()
+        backend.fail = False
+        await store.flush()
+        assert backend._data == {("users", "1"): '"a"', ("users", "2"): '"b"'}
+
+    asyncio.run(main())
+
+
+class _SlowBackend(MemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.reading = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def get(self, ns, key):
+        value = await super().get(ns, key)
+        self.reading.set()
+        await self.release.wait()
+        return value
+
+
+def test_put_during_a_backend_read_is_not_undone():
+    async def main():
+        backend = _SlowBackend()
+        store = StateStore(backend, flush_interval=3600)
+        allowed = store.namespace("allowed_retake")
+        read = asyncio.create_task(allowed.contains(7))
+        await backend.reading.wait()
+        allowed.add(7)
+        backend.release.set()
+        assert await read  # the read returns what was put meanwhile
+        await store.flush()
+        assert backend._data == {("allowed_retake", "7"): "true"}
+        assert await allowed.contains(7)
+
+    asyncio.run(main())
+
+
+def test_namespace_ttl_lets_other_workers_see_changes(tmp_path):
+    async def main():
+        stores = [StateStore(SQLiteBackend(str(tmp_path / "state.db")), flush_interval=3600) for _ in range(2)]
+        for store in stores:
+            await store.start()
+        respondent_shard, admin_shard = (store.namespace("allowed_retake", ttl=0.05) for store in stores)
+        assert not await respondent_shard.contains(42)  # the miss is cached
+        admin_shard.add(42)
+        await stores[1].flush()
+        await asyncio.sleep(0.06)
+        assert await respondent_shard.contains(42)
+        for store in stores:
+            await store.close()
+
+    asyncio.run(main())
+
+
+def test_incomplete_backend_fails_on_instantiation():
+    class NoKeys(StateBackend):
+        async def get(self, ns, key):
+            return None
+
+        async def set_many(self, items):
+            pass
+
+    with pytest.raises(TypeError):
+        NoKeys()
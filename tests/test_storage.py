@@ -0,0 +1,52 @@
+import asyncio
+import sqlite3
+
+from storage import MessageStore
+
+
+def _count(path) -> int:
+    conn = sqlite3.connect(str(path))
+    try:
+        return conn.execute("SELECT count(*) FROM messages").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_flush_waits_for_queued_writes(tmp_path):
+    async def main():
+        store = MessageStore(str(tmp_path / "db"), batch_size=50, flush_interval=0.5)
+        await store.start()
+        for i in range(120):
+            store.save_message(i % 7, f"message {i}", from_admin=False)
+        await store.flush()
+        assert _count(tmp_path / "db") == 120
+        assert await store.fetchall("SELECT count(*) FROM users") == [(7,)]
+        await store.close()
+
+    asyncio.run(main())
+
+
+def test_bad_statement_does_not_drop_the_rest_of_the_batch(tmp_path):
+    async def main():
+        store = MessageStore(str(tmp_path / "db"))
+        await store.start()
+        store.save_message(1, "before", from_admin=False)
+        store.enqueue("INSERT INTO no_such_table VALUES (?)", (1,))
+        store.save_message(1, "after", from_admin=False)
+        await store.flush()
+        assert await store.fetchall("SELECT text FROM messages ORDER BY id") == [("before",), ("after",)]
+        await store.close()
+
+    asyncio.run(main())
+
+
+def test_close_drains_the_queue(tmp_path):
+    async def main():
+        store = MessageStore(str(tmp_path / "db"), batch_size=64, flush_interval=10)
+        await store.start()
+        for i in range(1000):
+            store.save_message(i, "x", from_admin=False)
+        await store.close()
+        assert _count(tmp_path / "db") == 1000
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import json
+
+from sessions import Session
+from survey import SurveyRegistry, compile_survey
+
+BRANCHING = {
+    "id": "branching",
+    "questions": [
+        {"id": "a", "text": "A", "next": [{"match": "(?i)^yes", "goto": "c"}, {"goto": "b"}]},
+        {"id": "b", "text": "B", "next": [{"goto": "finish"}]},
+        {"id": "c", "text": "C"},
+    ],
+}
+
+
+def test_back_then_other_branch_drops_answers_of_the_old_branch():
+    survey = compile_survey(BRANCHING)
+    session = survey.new_session()
+    survey.record_answer(session, "no")
+    assert survey.advance(session)
+    survey.record_answer(session, "b-answer")
+    assert survey.back(session)
+    survey.record_answer(session, "yes")
+    assert survey.answered_indices(session) == [0, 1]
+    assert survey.advance(session)
+    assert survey.answered_indices(session) == [0]
+    assert survey.current(session).id == "c"
+    assert survey.current_answer(session) is None
+    assert not survey.advance(session)  # C still has to be answered
+    survey.record_answer(session, "c-answer")
+    assert survey.finished_answers(session) == [("A", "yes"), ("C", "c-answer")]
+
+
+def test_back_then_same_branch_keeps_answers():
+    survey = compile_survey(BRANCHING)
+    session = survey.new_session()
+    survey.record_answer(session, "no")
+    survey.advance(session)
+    survey.record_answer(session, "b-answer")
+    survey.back(session)
+    survey.record_answer(session, "nope")
+    assert survey.advance(session)
+    assert survey.current_answer(session) == "b-answer"
+
+
+def test_session_roundtrip_keeps_steps_ahead():
+    survey = compile_survey(BRANCHING)
+    session = survey.new_session()
+    survey.record_answer(session, "no")
+    survey.advance(session)
+    survey.record_answer(session, "b-answer")
+    survey.back(session)
+    restored = Session.load(session.dump())
+    assert (restored.path, restored.answers, restored.ahead) == ([0], ["no", "b-answer"], [1])
+    assert Session.load({"s": "x", "v": 1, "p": [0], "a": [], "w": True, "t": 0, "r": False}).ahead == []
+
+
+def _registry(directory, questions):
+    directory.mkdir()
+    (directory / "s.json").write_text(json.dumps({"id": "s", "questions": questions}))
+    registry = SurveyRegistry(str(directory), default_id="s")
+    registry.reload()
+    return registry
+
+
+def test_version_is_derived_from_the_definition(tmp_path):
+    session = _registry(tmp_path / "one", ["A", "B", "C-new"]).get().new_session()
+    # A restarted process, or another replica, that only knows a later edit of the survey.
+    restarted = _registry(tmp_path / "two", ["X", "Y"])
+    assert restarted.get().version != session.version
+    survey = restarted.for_session(session)
+    assert (session.survey, session.version) == ("s", survey.version)  # adopted, not silently reused
+    assert _registry(tmp_path / "three", ["A", "B", "C-new"]).get().version == _registry(
+        tmp_path / "four", ["A", "B", "C-new"]).get().version
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+import signal
+import time
+from typing import Optional
+
+from telegram import Bot, Update
+from telegram.ext import Application
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_UPDATE_KINDS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request", "message_reaction", "business_message", "edited_business_message",
+)
+
+
+def extract_user_id(data: dict) -> Optional[int]:
+    """User an update belongs to, read from the raw JSON without building an ``Update``."""
+    for kind in _UPDATE_KINDS:
+        payload = data.get(kind)
+        if not payload:
+            continue
+        sender = payload.get("from") or payload.get("user")
+        if sender:
+            return sender["id"]
+        chat = payload.get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+def shard_for(user_id: Optional[int], shards: int) -> int:
+    return (user_id or 0) % shards
+
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+class _WebhookHandler(RequestHandler):
+    def initialize(self, server):
+        self.server = server
+
+    def check_xsrf_cookie(self):
+        pass
+
+    def _authorized(self) -> bool:
+        secret = self.server.secret_token
+        return not secret or self.request.headers.get(SECRET_HEADER) == secret
+
+
+class _WorkerUpdateHandler(_WebhookHandler):
+    async def post(self):
+        if self.server.draining:
+            self.set_status(503)
+            return
+        if not self._authorized():
+            self.set_status(403)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.server.app.bot)
+        except (ValueError, KeyError, TypeError):
+            self.set_status(400)
+            return
+        self.server.received += 1
+        await self.server.app.update_queue.put(update)
+
+
+class _StatsHandler(RequestHandler):
+    def initialize(self, server):
+        self.server = server
+
+    def get(self):
+        self.write(self.server.stats())
+
+
+class _HealthHandler(RequestHandler):
+    def initialize(self, server):
+        self.server = server
+
+    def get(self):
+        self.set_status(503 if self.server.draining else 200)
+        self.write("draining" if self.server.draining else "ok")
+
+
+class WebhookWorker:
+    """Serves one shard: webhook POSTs go straight into ``app.update_queue``.
+
+    On SIGTERM/SIGINT the worker answers 503 to new updates (the router or Telegram retries
+    them), processes everything already queued and then stops the application, running
+    the post_init/post_stop/post_shutdown hooks like ``run_webhook`` does.
+    """
+
+    def __init__(self, app: Application, url_path: str = "/webhook", secret_token: Optional[str] = None):
+        self.app = app
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.draining = False
+        self.received = 0
+        self.started_at = time.monotonic()
+
+    def routes(self) -> list:
+        return [
+            (self.url_path, _WorkerUpdateHandler, {"server": self}),
+            ("/healthz", _HealthHandler, {"server": self}),
+            ("/stats", _StatsHandler, {"server": self}),
+        ]
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "received": self.received,
+            "queued": self.app.update_queue.qsize(),
+            "uptime": elapsed,
+            "updates_per_sec": self.received / elapsed if elapsed else 0.0,
+        }
+
+    async def serve(self, listen: str, port: int, webhook_url: Optional[str] = None, extra_routes: list = ()):
+        """Runs until a stop signal. ``webhook_url`` registers the webhook (single-replica mode)."""
+        app = self.app
+        stop = _stop_event()
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        if webhook_url:
+            await app.bot.set_webhook(webhook_url, secret_token=self.secret_token,
+                                      allowed_updates=Update.ALL_TYPES)
+        server = HTTPServer(WebApplication(self.routes() + list(extra_routes)))
+        server.listen(port, listen)
+        self.started_at = time.monotonic()
+        logger.info("Webhook worker listening on %s:%d%s", listen, port, self.url_path)
+        try:
+            await stop.wait()
+        finally:
+            logger.info("Draining %d queued updates", app.update_queue.qsize())
+            self.draining = True
+            server.stop()
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+            await app.shutdown()
+            if app.post_shutdown:
+                await app.post_shutdown(app)
+            await server.close_all_connections()
+
+
+class _RouterUpdateHandler(_WebhookHandler):
+    async def post(self):
+        if self.server.draining:
+            self.set_status(503)
+            return
+        if not self._authorized():
+            self.set_status(403)
+            return
+        try:
+            user_id = extract_user_id(json.loads(self.request.body))
+        except ValueError:
+            self.set_status(400)
+            return
+        self.set_status(await self.server.forward(user_id, self.request.body))
+
+
+class WebhookRouter:
+    """Front door for several ``WebhookWorker`` replicas.
+
+    Updates are sharded on user id, so one user always lands on the same worker, and are
+    forwarded one at a time per user so that worker receives them in arrival order.
+    """
+
+    def __init__(self, worker_urls: list[str], url_path: str = "/webhook",
+                 secret_token: Optional[str] = None, timeout: float = 10.0):
+        self.worker_urls = worker_urls
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.timeout = timeout
+        self.draining = False
+        self.forwarded = [0] * len(worker_urls)
+        self.errors = [0] * len(worker_urls)
+        self.started_at = time.monotonic()
+        self._user_locks: dict[int, list] = {}  # user_id -> [lock, requests holding or waiting]
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._client = AsyncHTTPClient(max_clients=256)
+
+    def routes(self) -> list:
+        return [
+            (self.url_path, _RouterUpdateHandler, {"server": self}),
+            ("/healthz", _HealthHandler, {"server": self}),
+            ("/stats", _StatsHandler, {"server": self}),
+        ]
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "workers": [
+                {"url": url, "forwarded": sent, "errors": errors,
+                 "updates_per_sec": sent / elapsed if elapsed else 0.0}
+                for url, sent, errors in zip(self.worker_urls, self.forwarded, self.errors)
+            ],
+            "in_flight": self._in_flight,
+            "uptime": elapsed,
+        }
+
+    async def forward(self, user_id: Optional[int], body: bytes) -> int:
+        shard = shard_for(user_id, len(self.worker_urls))
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            async with entry[0]:
+                headers = {"Content-Type": "application/json"}
+                if self.secret_token:
+                    headers[SECRET_HEADER] = self.secret_token
+                request = HTTPRequest(self.worker_urls[shard] + self.url_path, method="POST", body=body,
+                                      headers=headers, request_timeout=self.timeout)
+                try:
+                    await self._client.fetch(request)
+                except HTTPClientError as e:
+                    self.errors[shard] += 1
+                    return e.code if e.code != 599 else 502
+                except OSError:
+                    self.errors[shard] += 1
+                    return 502
+                self.forwarded[shard] += 1
+                return 200
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user_id]
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def serve(self, listen: str, port: int, bot: Optional[Bot] = None, webhook_url: Optional[str] = None,
+                    extra_routes: list = ()):
+        """Runs until a stop signal, then finishes in-flight forwards before exiting."""
+        stop = _stop_event()
+        server = HTTPServer(WebApplication(self.routes() + list(extra_routes)))
+        server.listen(port, listen)
+        self.started_at = time.monotonic()
+        if bot and webhook_url:
+            async with bot:
+                await bot.set_webhook(webhook_url, secret_token=self.secret_token,
+                                      allowed_updates=Update.ALL_TYPES)
+        logger.info("Webhook router on %s:%d%s -> %s", listen, port, self.url_path, ", ".join(self.worker_urls))
+        try:
+            await stop.wait()
+        finally:
+            self.draining = True
+            server.stop()
+            await self._idle.wait()
+            await server.close_all_connections()